@@ -1,142 +1,125 @@
 import pandas as pd
-import matplotlib.pyplot as plt 
-import seaborn as sns
-from matplotlib.ticker import MultipleLocator, FormatStrFormatter, AutoMinorLocator
-import scipy.stats as stats 
-import numpy as np 
-
-
-sheet = pd.read_csv("merged_df.csv").convert_dtypes()
-print(sheet.describe())
-
-# Total Sales per chip company and customer type over the full period
-grouped = sheet.groupby(['lifestage', 'product_name'])
-sales = grouped['total_sales'].sum().reset_index()
-plt.figure(figsize=(12, 8))
-sns.catplot(data=sales, x='product_name', y='total_sales', hue='lifestage', kind="bar", height=8, aspect=1.5)
-plt.title('Total Sales of Chip Product per Customer Category')
-plt.xlabel('Product Name')
-plt.ylabel('Total Sales')
-plt.xticks(rotation=90)
-plt.tight_layout()
-plt.show()
-
-
-# # Understanding customer segments
-# # Are there more customer than chip purchases - multi-pack purchases
-grouped = sheet.groupby(['lifestage', 'premium_customer'])
-average_quantity = grouped['product_quantity'].mean().reset_index()
-average_quantity.columns = ['lifestage', 'premium_customer', 'average_quantity']
-print(average_quantity)
-plt.figure(figsize=(12,8))
-sns.barplot(data=average_quantity, x='lifestage', y='average_quantity', hue='premium_customer', errorbar=None, palette='muted')
-plt.xlabel('Lifestage')
-plt.ylabel('Average Quantity')
-plt.title('Average Quantity of Chips Spent by Customer Type')
-plt.legend(title='Customer Type', bbox_to_anchor=(1.05, 1), loc='upper left')
-plt.tight_layout()
-plt.show()
-
-# Older and younger families buy more chip packs on average per purchase, however it is differences in average quantities aren't large, we can check if this difference is significant
-
-# Welch t-test on quantities between sales from mainstream young singles/couples and mainstream midage singles/couples
-young_single_couple = sheet[(sheet['lifestage'] == 'YOUNG SINGLES/COUPLES') & (sheet['premium_customer'] == 'Mainstream')]
-
-midage_singles_couple = sheet[(sheet['lifestage'] == 'MIDAGE SINGLES/COUPLES') & (sheet['premium_customer'] == 'Mainstream')]
-
-print(stats.ttest_ind(young_single_couple['product_quantity'], midage_singles_couple['product_quantity'], equal_var = False))
-
-# Yes all customers are spending on average more than one chip purchase per transaction
-# - Who spends the most on chips (Average sales), describing customers by lifestage and purchasing power
-grouped = sheet.groupby(['lifestage', 'premium_customer'])
-average_sales = grouped['total_sales'].mean().reset_index()
-average_sales.columns = ['lifestage', 'premium_customer', 'average_sales']
-print(average_sales)
-plt.figure(figsize=(12,8))
-sns.barplot(data=average_sales, x='lifestage', y='average_sales', hue='premium_customer', errorbar=None, palette='muted')
-plt.xlabel('Lifestage')
-plt.ylabel('Average Sales')
-plt.title('Average Sales Grouped by Customer Type')
-plt.legend(title='Customer Type', bbox_to_anchor=(1.05, 1), loc='upper left')
-plt.tight_layout()
-plt.show()
-
-# Average chip count purchase 
-grouped = sheet.groupby(['lifestage', 'premium_customer'])
-average_pack_size = grouped['pack_size'].mean().reset_index()
-average_pack_size.columns = ['lifestage', 'premium_customer', 'pack_size']
-
-# print(average_pack_size)
-plt.figure(figsize=(12,8))
-# plt.gca().yaxis.set_major_locator(MultipleLocator(0.05))  # Set the interval between major ticks
-# plt.gca().yaxis.set_major_formatter(FormatStrFormatter('%.2f'))  # Format tick labels to two decimal places
-# plt.ylim(0, max(average_quantity['average_quantity']) * 1.2)
-sns.barplot(data=average_pack_size, x='lifestage', y='pack_size', hue='premium_customer', errorbar=None, palette='muted')
-plt.xlabel('Lifestage')
-plt.ylabel('Average Pack Size')
-plt.title('Average Pack Size of Chips Spent by Customer Type')
-plt.legend(title='Customer Type', bbox_to_anchor=(1.05, 1), loc='upper left')
-plt.tight_layout()
-plt.show()
-# Mainstream young and midage singles/couples are leading the sales of chip purchases
-# How premium their general purchasing behaviour is
-# How many customers are in each segment
-total_cust = sheet.groupby(['lifestage', 'premium_customer']).size().reset_index(name='counts')
-
-# Sort the results
-total_cust = total_cust.sort_values(by=['lifestage', 'premium_customer']).reset_index(drop=True)
-
-print(total_cust)
-# - How many chips are bought per customer by segment
-grouped = sheet.groupby(['lifestage', 'premium_customer'])
-total_sales = grouped['total_sales'].sum().reset_index(name='Revenue')
-total_sales = total_sales.sort_values(by=['lifestage', 'premium_customer']).reset_index(drop=True)
-print(total_sales)
-
-sheet['date'] = pd.to_datetime(sheet['date'])
-sheet['month'] = sheet['date'].dt.strftime('%Y%m')
-# mainstream retirees, young singles and budget older families are driving sales
-
-# Customer spending type, how do they track in terms of spending per month
-grouped = sheet.groupby(['premium_customer', 'month'])
-sales = grouped['total_sales'].sum().reset_index()
-sales.to_csv("sales_customer_spending_type.csv", index=False)
-plt.figure(figsize=(12, 8))
-sns.lineplot(data=sales, x='month', y='total_sales', hue='premium_customer', marker='o')
-plt.title('Total Monthly Sales based on Spending Type')
-plt.xlabel('Month')
-plt.ylabel('Total Sales')
-plt.legend(title='Lifestage', bbox_to_anchor=(1.05, 1), loc='upper left')
-plt.legend(title='Customer Spending Type')
-plt.tight_layout()
-plt.show()
-
-
-# Customer spending based on lifestage, how much is spent per month
-grouped = sheet.groupby(['lifestage', 'month'])
-sales = grouped['total_sales'].sum().reset_index()
-sales.to_csv("sales_lifestage.csv", index=False)
-plt.figure(figsize=(12, 8))
-sns.lineplot(data=sales, x='month', y='total_sales', hue='lifestage', marker='o')
-plt.title('Total Monthly Sales based on Lifestage of the Customer')
-plt.xlabel('Month')
-plt.ylabel('Total Sales')
-plt.legend(title='Lifestage', bbox_to_anchor=(1.05, 1), loc='upper left')
-plt.tight_layout()
-plt.show()
-# On average older singles, families, couples and retirees are spending more on chips across the month
-
-# Customer spending based on lifestage and spending type per month
-grouped = sheet.groupby(['lifestage', 'premium_customer', 'month'])
-sales = grouped['total_sales'].sum().reset_index()
-sales['cust_type'] = sales['lifestage'] + ' - ' + sales['premium_customer'].astype(str)
-sales.to_csv("sales_lifestage.csv", index=False)
-plt.figure(figsize=(12, 8))
-sns.lineplot(data=sales, x='month', y='total_sales', hue='cust_type', marker='o')
-plt.title('Total Monthly Sales based on Lifestage of the Customer')
-plt.xlabel('Month')
-plt.ylabel('Total Sales')
-plt.legend(title='Lifestage', bbox_to_anchor=(1.05, 1), loc='upper left')
-plt.tight_layout()
-plt.show()
 
+from qvi_cache import load_merged
+from qvi_affinity import segment_affinity, top_affinities
+from qvi_aggregates import write_monthly_tables
+from qvi_cube import segment_cube, rollup, segment_mean, monthly_totals
+from qvi_render import render_charts
+from qvi_resample import mean_difference
+from qvi_significance import segment_significance
+from qvi_plots import line_chart, segment_bar_chart, brand_sales_chart
+
+
+# Compute functions only need pandas, the charts and the t-test import their libraries when they run
+
+def segment_summaries(cube):
+    # Every per segment measure is a roll-up of the cached segment cube
+    summaries = {}
+    # Total Sales per chip company and customer type over the full period
+    summaries['brand_sales'] = rollup(cube, ['lifestage', 'product_name'])[['lifestage', 'product_name', 'total_sales']]
+    average_quantity = segment_mean(cube, ['lifestage', 'premium_customer'], 'product_quantity')
+    average_quantity.columns = ['lifestage', 'premium_customer', 'average_quantity']
+    summaries['average_quantity'] = average_quantity
+    average_sales = segment_mean(cube, ['lifestage', 'premium_customer'], 'total_sales')
+    average_sales.columns = ['lifestage', 'premium_customer', 'average_sales']
+    summaries['average_sales'] = average_sales
+    summaries['average_pack_size'] = segment_mean(cube, ['lifestage', 'premium_customer'], 'pack_size')
+    segments = rollup(cube, ['lifestage', 'premium_customer'])
+    total_cust = segments[['lifestage', 'premium_customer', 'count']].rename(columns={'count': 'counts'})
+    summaries['total_cust'] = total_cust.sort_values(by=['lifestage', 'premium_customer']).reset_index(drop=True)
+    total_sales = segments[['lifestage', 'premium_customer', 'total_sales']].rename(columns={'total_sales': 'Revenue'})
+    summaries['total_sales'] = total_sales.sort_values(by=['lifestage', 'premium_customer']).reset_index(drop=True)
+    return summaries
+
+
+def monthly_summaries(cube):
+    # Monthly sales per spending type, lifestage and both, roll-ups of the cube's month key
+    monthly = {
+        'spending_type': monthly_totals(cube, ['premium_customer']),
+        'lifestage': monthly_totals(cube, ['lifestage']),
+        'customer_type': monthly_totals(cube, ['lifestage', 'premium_customer'])
+    }
+    monthly['customer_type']['cust_type'] = monthly['customer_type']['lifestage'] + ' - ' + monthly['customer_type']['premium_customer']
+    return monthly
+
+
+def segment_t_test(significance, first, second, measure='product_quantity'):
+    # Welch t-test on a measure between two (lifestage, premium_customer) segments, read from the significance
+    # table and turned round when the table holds the pair the other way
+    first, second = ' - '.join(first), ' - '.join(second)
+    rows = significance[significance['measure'] == measure]
+    row, sign = rows[(rows['first'] == first) & (rows['second'] == second)], 1
+    if row.empty:
+        row, sign = rows[(rows['first'] == second) & (rows['second'] == first)], -1
+    row = row.iloc[0]
+    return pd.Series({'first': first, 'second': second, 'mean_diff': sign * row['mean_diff'], 't_stat': sign * row['t_stat'],
+                      'df': row['df'], 'p_value': row['p_value'], 'p_adjusted': row['p_adjusted']}, name=measure)
+
+
+def segment_difference(sheet, first, second, measure='product_quantity', workers=1):
+    # Bootstrap interval and permutation p-value for the same comparison, workers > 1 spreads the resample batches over processes
+    first_rows = sheet[(sheet['lifestage'] == first[0]) & (sheet['premium_customer'] == first[1])]
+    second_rows = sheet[(sheet['lifestage'] == second[0]) & (sheet['premium_customer'] == second[1])]
+    return mean_difference(first_rows[measure], second_rows[measure], workers=workers)
+
+
+def summary_charts(summaries, monthly):
+    return [
+        ('brand_sales_by_lifestage', brand_sales_chart, dict(data=summaries['brand_sales'])),
+        ('average_quantity', segment_bar_chart, dict(data=summaries['average_quantity'], y='average_quantity', ylabel='Average Quantity', title='Average Quantity of Chips Spent by Customer Type')),
+        ('average_sales', segment_bar_chart, dict(data=summaries['average_sales'], y='average_sales', ylabel='Average Sales', title='Average Sales Grouped by Customer Type')),
+        ('average_pack_size', segment_bar_chart, dict(data=summaries['average_pack_size'], y='pack_size', ylabel='Average Pack Size', title='Average Pack Size of Chips Spent by Customer Type')),
+        ('monthly_sales_spending_type', line_chart, dict(data=monthly['spending_type'], x='month', y='total_sales', hue='premium_customer', title='Total Monthly Sales based on Spending Type', xlabel='Month', ylabel='Total Sales', legend_title='Customer Spending Type')),
+        ('monthly_sales_lifestage', line_chart, dict(data=monthly['lifestage'], x='month', y='total_sales', hue='lifestage', title='Total Monthly Sales based on Lifestage of the Customer', xlabel='Month', ylabel='Total Sales', legend_title='Lifestage', legend_outside=True)),
+        ('monthly_sales_customer_type', line_chart, dict(data=monthly['customer_type'], x='month', y='total_sales', hue='cust_type', title='Total Monthly Sales based on Lifestage of the Customer', xlabel='Month', ylabel='Total Sales', legend_title='Lifestage', legend_outside=True))
+    ]
+
+
+def main():
+    sheet = load_merged()
+    print(sheet.describe())
+    cube = segment_cube()
+    summaries = segment_summaries(cube)
+
+    # # Understanding customer segments
+    # # Are there more customer than chip purchases - multi-pack purchases
+    print(summaries['average_quantity'])
+
+    # Older and younger families buy more chip packs on average per purchase, however it is differences in average quantities aren't large, we can check if this difference is significant
+
+    # Every pair of segments on quantity, sales and pack size, Welch tests from the cube aggregates
+    significance = segment_significance()
+    # Welch t-test on quantities between sales from mainstream young singles/couples and mainstream midage singles/couples
+    print(segment_t_test(significance, ('YOUNG SINGLES/COUPLES', 'Mainstream'), ('MIDAGE SINGLES/COUPLES', 'Mainstream')))
+    print(segment_difference(sheet, ('YOUNG SINGLES/COUPLES', 'Mainstream'), ('MIDAGE SINGLES/COUPLES', 'Mainstream')))
+    print(significance[significance['significant']])
+
+    # Yes all customers are spending on average more than one chip purchase per transaction
+    # - Who spends the most on chips (Average sales), describing customers by lifestage and purchasing power
+    print(summaries['average_sales'])
+
+    # Which brands and pack sizes each segment buys more of than customers overall (index > 100), and
+    # the products most often bought together in one transaction
+    affinity = segment_affinity()
+    print(top_affinities(affinity['brand'], 'brand'))
+    print(top_affinities(affinity['pack_size'], 'pack_size'))
+    print(affinity['pairs'].head(10))
+
+    # Mainstream young and midage singles/couples are leading the sales of chip purchases
+    # How premium their general purchasing behaviour is
+    # How many customers are in each segment
+    print(summaries['total_cust'])
+    # - How many chips are bought per customer by segment
+    print(summaries['total_sales'])
+
+    # Monthly totals are roll-ups of the cube's month key too; qvi_aggregates.py keeps the incremental segment
+    # state for appending newly landed batches between cube rebuilds
+    monthly = monthly_summaries(cube)
+    write_monthly_tables(monthly)
+    # mainstream retirees, young singles and budget older families are driving sales
+    # On average older singles, families, couples and retirees are spending more on chips across the month
+    render_charts(summary_charts(summaries, monthly))
+
+
+if __name__ == '__main__':
+    main()
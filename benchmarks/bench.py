@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+# Pipeline benchmark on synthetic data.
+# Generates a QVI-shaped dataset with synth.py, then times each pipeline stage in its own
+# interpreter so every stage gets a clean peak RSS reading. Linux carries the peak RSS across exec,
+# so this driver never imports pandas itself. Each stage keeps its best of --repeat runs, and the
+# run fails when a stage is more than --tolerance (and MIN_REGRESSION_S) slower than the stored
+# baseline for the same row count.
+#
+#   python benchmarks/bench.py --rows 1e5
+#   python benchmarks/bench.py --rows 1e6 --update-baseline
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+STAGES = ['cleanse', 'cache_build', 'cache_load', 'segment_cube', 'segment_state', 'control_matching', 'affinity']
+TRIAL_STORES = [77, 86, 88]
+MIN_REGRESSION_S = 0.05
+MERGED_COLUMNS = ['date', 'store_number', 'loyalty_card_number', 'total_sales']
+
+
+def stage_setup(stage):
+    # Work that a stage needs done first but that isn't part of what it measures
+    from qvi_cache import load_merged
+    if stage in ('segment_cube', 'segment_state'):
+        return load_merged(mmap=False)
+    if stage == 'control_matching':
+        sheet = load_merged(columns=MERGED_COLUMNS, mmap=False)
+        sheet['month'] = sheet['date'].dt.strftime('%Y%m')
+        return sheet
+    return None
+
+
+def stage_run(stage, data):
+    if stage == 'cleanse':
+        from qvi_cleanse import cleanse_transactions
+        cleanse_transactions("QVI_transaction_data.csv", "QVI_purchase_behaviour.csv", transactions_out=None)
+    elif stage == 'cache_build':
+        from qvi_cache import load_merged
+        shutil.rmtree(".qvi_cache", ignore_errors=True)
+        load_merged()
+    elif stage == 'cache_load':
+        from qvi_cache import load_merged
+        frame = load_merged()
+        # Touch every column so memory-mapped pages are actually read
+        for column in frame.columns:
+            frame[column].to_numpy().copy()
+    elif stage == 'segment_cube':
+        from qvi_cube import build_cube
+        build_cube(data)
+    elif stage == 'segment_state':
+        from qvi_aggregates import segment_month_state
+        segment_month_state(data)
+    elif stage == 'control_matching':
+        from qvi_trials import store_month_metrics, metric_matrix, rank_control_stores
+        potential_control = [store for store in data['store_number'].unique() if store not in TRIAL_STORES]
+        rank_control_stores(metric_matrix(store_month_metrics(data), 'total_sales'), TRIAL_STORES, potential_control)
+    elif stage == 'affinity':
+        from qvi_affinity import affinity_tables
+        affinity_tables()
+    else:
+        raise ValueError(f"Unknown stage {stage}")
+
+
+def measure_stage(stage, data_dir):
+    # Runs inside the child interpreter
+    import qvi_stages
+    os.chdir(data_dir)
+    run = qvi_stages.new_run('bench', profile_dir=None)
+    data = stage_setup(stage)
+    start = time.perf_counter()
+    # The stage's peak comes from the run, which keeps it even if anything inside resets the high-water mark
+    with qvi_stages.stage(run, stage):
+        stage_run(stage, data)
+    return {'seconds': time.perf_counter() - start, 'peak_rss_mb': qvi_stages.run_peak_rss_mb(run)}
+
+
+def run_stage(stage, data_dir):
+    command = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--data', data_dir]
+    output = subprocess.run(command, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(rows, data_dir, seed=0, repeat=3):
+    synth = os.path.join(os.path.dirname(os.path.abspath(__file__)), "synth.py")
+    start = time.perf_counter()
+    subprocess.run([sys.executable, synth, str(rows), data_dir, str(seed)], check=True)
+    results = {'generate': {'seconds': time.perf_counter() - start, 'peak_rss_mb': None}}
+    for stage in STAGES:
+        runs = [run_stage(stage, data_dir) for _ in range(repeat)]
+        results[stage] = min(runs, key=lambda run: run['seconds'])
+    return results
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for stage in STAGES:
+        seconds, base = results[stage]['seconds'], baseline.get(stage, {}).get('seconds')
+        if base is not None and seconds > base * (1 + tolerance) and seconds - base > MIN_REGRESSION_S:
+            found.append(stage)
+    return found
+
+
+def print_results(results, baseline):
+    print(f"{'stage':<18}{'seconds':>10}{'baseline':>10}{'peak MB':>10}")
+    for stage, result in results.items():
+        base = baseline.get(stage, {}).get('seconds')
+        peak = result['peak_rss_mb']
+        print(f"{stage:<18}{result['seconds']:>10.3f}{'' if base is None else f'{base:.3f}':>10}{'' if peak is None else f'{peak:.0f}':>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the QVI pipeline stages on synthetic data")
+    parser.add_argument('--rows', type=float, default=1e5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--keep', help="directory to generate the data in and keep afterwards")
+    parser.add_argument('--stage', help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        print(json.dumps(measure_stage(args.stage, args.data)))
+        return 0
+
+    rows = int(args.rows)
+    data_dir = args.keep or tempfile.mkdtemp(prefix="qvi_bench_")
+    try:
+        results = run_benchmark(rows, data_dir, args.seed, args.repeat)
+    finally:
+        if not args.keep:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    baselines = load_baseline()
+    baseline = baselines.get(str(rows), {})
+    print_results(results, baseline)
+    if args.update_baseline:
+        baselines[str(rows)] = results
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        return 0
+    slow = regressions(results, baseline, args.tolerance)
+    if slow:
+        print(f"Slower than baseline by more than {args.tolerance:.0%}: {', '.join(slow)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+
+
+# Import-time budget for the compute-only path.
+# Importing the analysis scripts and the qvi_* modules must not pull in the plotting or statistics
+# libraries, and has to fit in IMPORT_BUDGET_S seconds. Each measurement is a fresh interpreter so
+# nothing is already cached in sys.modules; the best of a few runs is kept to smooth out noise.
+#
+#   python benchmarks/import_budget.py [budget_seconds]
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMPUTE_MODULES = [
+    'QVI', 'QVI_data_summaries', 'store_trial',
+    'qvi_affinity', 'qvi_aggregates', 'qvi_cache', 'qvi_cleanse', 'qvi_cube', 'qvi_customers', 'qvi_hll', 'qvi_plots', 'qvi_render', 'qvi_resample', 'qvi_run', 'qvi_significance', 'qvi_stages', 'qvi_trials'
+]
+DEFERRED_MODULES = ['matplotlib', 'seaborn', 'scipy']
+IMPORT_BUDGET_S = 1.0
+RUNS = 3
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def measure_imports(modules=COMPUTE_MODULES, deferred=DEFERRED_MODULES, runs=RUNS):
+    code = MEASURE.format(modules=list(modules), deferred=list(deferred))
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, capture_output=True, text=True, check=True)
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return min(results, key=lambda result: result['seconds'])
+
+
+def main(budget=IMPORT_BUDGET_S):
+    result = measure_imports()
+    print(f"Compute-only imports took {result['seconds']:.3f}s (budget {budget:.3f}s)")
+    ok = result['seconds'] <= budget
+    if result['loaded']:
+        print(f"Imported eagerly: {', '.join(result['loaded'])}")
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(float(sys.argv[1]) if len(sys.argv) > 1 else IMPORT_BUDGET_S))
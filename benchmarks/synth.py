@@ -0,0 +1,217 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+
+# Synthetic QVI-shaped data for benchmarking.
+# Writes QVI_purchase_behaviour.csv and QVI_transaction_data.csv with the raw column names, so the
+# output can be fed straight to qvi_cleanse. Distributions follow the bundled data: the customer
+# lifestage x premium mix, a brand / pack size mix that includes salsa and the inconsistent brand
+# spellings, mostly two-pack purchases, a pre-Christmas spike in December and no trade on
+# Christmas Day. A few duplicate rows and 200-pack outliers are planted for the cleansing to find.
+# Like the bundled data, a small share of transactions hold more than one product.
+# Customers and transactions are both generated and appended in chunks. Nothing is kept per
+# customer: a customer's card and store follow from its index and the per-store counts, and its
+# shopping activity from a hash of the index, so memory is bounded by the chunk size at any row count.
+#
+#   python benchmarks/synth.py <rows> <output_dir> [seed]
+
+# Share of customers in each (lifestage, premium_customer) segment in QVI_purchase_behaviour.csv
+SEGMENT_SHARES = {
+    ('MIDAGE SINGLES/COUPLES', 'Budget'): 0.0207, ('MIDAGE SINGLES/COUPLES', 'Mainstream'): 0.0460, ('MIDAGE SINGLES/COUPLES', 'Premium'): 0.0335,
+    ('NEW FAMILIES', 'Budget'): 0.0153, ('NEW FAMILIES', 'Mainstream'): 0.0117, ('NEW FAMILIES', 'Premium'): 0.0081,
+    ('OLDER FAMILIES', 'Budget'): 0.0644, ('OLDER FAMILIES', 'Mainstream'): 0.0390, ('OLDER FAMILIES', 'Premium'): 0.0313,
+    ('OLDER SINGLES/COUPLES', 'Budget'): 0.0679, ('OLDER SINGLES/COUPLES', 'Mainstream'): 0.0679, ('OLDER SINGLES/COUPLES', 'Premium'): 0.0654,
+    ('RETIREES', 'Budget'): 0.0613, ('RETIREES', 'Mainstream'): 0.0892, ('RETIREES', 'Premium'): 0.0533,
+    ('YOUNG FAMILIES', 'Budget'): 0.0553, ('YOUNG FAMILIES', 'Mainstream'): 0.0376, ('YOUNG FAMILIES', 'Premium'): 0.0335,
+    ('YOUNG SINGLES/COUPLES', 'Budget'): 0.0520, ('YOUNG SINGLES/COUPLES', 'Mainstream'): 0.1113, ('YOUNG SINGLES/COUPLES', 'Premium'): 0.0354
+}
+
+# (product name, price per pack, relative popularity)
+PRODUCTS = [
+    ('Natural Chip        Compny SeaSalt175g', 3.0, 1.0),
+    ('NCC Sour Cream &    Garden Chives 175g', 3.0, 0.5),
+    ('CCs Nacho Cheese    175g', 2.1, 0.9),
+    ('CCs Original 175g', 2.1, 0.9),
+    ('Smiths Crinkle Cut  Chips Chicken 170g', 2.9, 1.0),
+    ('Smiths Crinkle      Original 330g', 5.7, 1.4),
+    ('Smith Crinkle Cut   Mac N Cheese 150g', 2.6, 0.6),
+    ('Kettle Tortilla ChpsHny&Jlpno Chili 150g', 4.6, 2.0),
+    ('Kettle Sensations   Camembert & Fig 150g', 4.6, 2.0),
+    ('Kettle Mozzarella   Basil & Pesto 175g', 5.4, 2.0),
+    ('Kettle 135g Swt Pot Sea Salt', 4.2, 1.6),
+    ('Grain Waves         Sweet Chilli 210g', 3.6, 1.0),
+    ('GrnWves Plus Btroot & Chilli Jam 180g', 3.1, 0.6),
+    ('Doritos Corn Chips  Original 170g', 4.4, 1.6),
+    ('Dorito Corn Chp     Supreme 380g', 6.5, 1.0),
+    ('Doritos Mexicana    170g', 4.4, 1.6),
+    ('Twisties Cheese     270g', 4.6, 1.0),
+    ('Twisties Chicken270g', 4.6, 1.0),
+    ('WW Original Stacked Chips 160g', 1.9, 0.6),
+    ('Woolworths Cheese   Rings 190g', 1.8, 0.6),
+    ('Thins Chips Light&  Tangy 175g', 3.3, 1.5),
+    ('Thins Potato Chips  Hot & Spicy 175g', 3.3, 1.5),
+    ('Burger Rings 220g', 2.3, 0.5),
+    ('Cheezels Cheese 330g', 5.7, 1.0),
+    ('Infzns Crn Crnchers Tangy Gcamole 110g', 3.8, 0.7),
+    ('Infuzions BBQ Rib   Prawn Crackers 110g', 3.8, 0.9),
+    ('Red Rock Deli Chikn&Garlic Aioli 150g', 2.7, 0.8),
+    ('RRD Sweet Chilli &  Sour Cream 165g', 3.0, 0.9),
+    ('Pringles Sthrn FriedChicken 134g', 3.7, 1.5),
+    ('Pringles SourCream  Onion 134g', 3.7, 1.5),
+    ('Tyrrells Crisps     Ched & Chives 165g', 4.2, 0.8),
+    ('Cobs Popd Sea Salt  Chips 110g', 3.8, 1.2),
+    ('French Fries Potato Chips 175g', 3.0, 0.3),
+    ('Tostitos Splash Of  Lime 175g', 4.4, 1.2),
+    ('Cheetos Chs & Bacon Balls 190g', 3.3, 0.6),
+    ('Snbts Whlgrn Crisps Cheddr&Mstrd 90g', 1.7, 0.6),
+    ('Sunbites Whlegrn    Crisps Frch/Onin 90g', 1.7, 0.6),
+    ('Old El Paso Salsa   Dip Tomato Mild 300g', 5.1, 1.2),
+    ('Woolworths Medium   Salsa 300g', 1.5, 0.6),
+    ('Doritos Salsa       Medium 300g', 2.6, 0.6)
+]
+
+QUANTITIES = [1, 2, 3, 4, 5]
+QUANTITY_SHARES = [0.09, 0.89, 0.01, 0.005, 0.005]
+
+STORES = 272
+FIRST_DAY = pd.Timestamp('2018-07-01')
+LAST_DAY = pd.Timestamp('2019-06-30')
+EXCEL_EPOCH = pd.Timestamp('1899-12-30')
+ROWS_PER_CUSTOMER = 3.6
+CHUNK_ROWS = 1_000_000
+ACTIVITY_CAP = 8.0
+# Products per transaction, the bundled data has 264,836 lines in 263,127 transactions
+BASKET_LINES = [1, 2, 3]
+BASKET_SHARES = [0.9930, 0.0065, 0.0005]
+
+
+def day_weights():
+    days = pd.date_range(FIRST_DAY, LAST_DAY)
+    weights = np.ones(len(days))
+    # Trade builds through December to a peak just before Christmas, and shops shut on Christmas Day
+    december = (days.month == 12) & (days.day < 25)
+    weights[december] += 0.3 * days.day[december] / 24
+    weights[(days.month == 12) & (days.day == 25)] = 0
+    serials = (days - EXCEL_EPOCH).days.to_numpy()
+    return serials, weights / weights.sum()
+
+
+def customer_layout(n_customers, rng):
+    # Customers per store, cards are numbered store first like the bundled data
+    counts = rng.multinomial(n_customers, np.full(STORES, 1 / STORES))
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    width = 10 ** max(3, len(str(int(counts.max()))))
+    return starts, width
+
+
+def customer_cards(index, starts, width):
+    # Card and store of customers by index, so no per customer table has to be held
+    store = np.searchsorted(starts, index, side='right')
+    return store * width + index - starts[store - 1], store
+
+
+def customer_activity(index, seed):
+    # Some customers shop far more often than others: an exponential activity, capped at ACTIVITY_CAP, from a
+    # splitmix64 hash of the customer's index and the seed
+    with np.errstate(over='ignore'):
+        # The seed's multiple wraps around in uint64 like the rest of the hash, numpy only warns on scalars
+        z = np.asarray(index).astype(np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    uniform = ((z ^ (z >> np.uint64(31))) >> np.uint64(11)).astype(np.float64) / 2 ** 53
+    return np.minimum(-np.log1p(-uniform), ACTIVITY_CAP)
+
+
+def draw_customers(rng, n_customers, size, seed):
+    # Customers drawn in proportion to their activity by rejection sampling, about 1 in ACTIVITY_CAP candidates is kept
+    drawn, found = [], 0
+    while found < size:
+        candidates = rng.integers(0, n_customers, size=min(int((size - found) * ACTIVITY_CAP * 1.2) + 16, CHUNK_ROWS))
+        accepted = candidates[rng.random(len(candidates)) * ACTIVITY_CAP < customer_activity(candidates, seed)][:size - found]
+        drawn.append(accepted)
+        found += len(accepted)
+    return np.concatenate(drawn)
+
+
+def iter_customers(n_customers, starts, width, rng, chunksize=CHUNK_ROWS):
+    segments = list(SEGMENT_SHARES)
+    shares = np.array([SEGMENT_SHARES[segment] for segment in segments])
+    lifestages = np.array([lifestage for lifestage, premium in segments], dtype=object)
+    premiums = np.array([premium for lifestage, premium in segments], dtype=object)
+    for start in range(0, n_customers, chunksize):
+        index = np.arange(start, min(start + chunksize, n_customers))
+        segment = rng.choice(len(segments), size=len(index), p=shares / shares.sum())
+        yield pd.DataFrame({
+            'LYLTY_CARD_NBR': customer_cards(index, starts, width)[0],
+            'LIFESTAGE': lifestages[segment],
+            'PREMIUM_CUSTOMER': premiums[segment]
+        })
+
+
+def basket_lines(rng, size):
+    # Products per transaction for size rows, the last basket cut short to fit; returns each row's basket and line within it
+    lines = rng.choice(BASKET_LINES, size=size, p=BASKET_SHARES)
+    ends = np.cumsum(lines)
+    n_baskets = int(np.searchsorted(ends, size)) + 1
+    lines = lines[:n_baskets]
+    lines[-1] -= ends[n_baskets - 1] - size
+    basket = np.repeat(np.arange(n_baskets), lines)
+    line = np.arange(size) - (np.cumsum(lines) - lines)[basket]
+    return basket, line, n_baskets
+
+
+def iter_transactions(n_customers, starts, width, n_rows, rng, seed=0, chunksize=CHUNK_ROWS):
+    # Customers always shop at their home store, every line of a transaction shares its customer and day
+    names = np.array([name for name, price, popularity in PRODUCTS], dtype=object)
+    prices = np.array([price for name, price, popularity in PRODUCTS])
+    popularity = np.array([popularity for name, price, popularity in PRODUCTS])
+    serials, weights = day_weights()
+    written = baskets_written = 0
+    while written < n_rows:
+        size = min(chunksize, n_rows - written)
+        basket, line, n_baskets = basket_lines(rng, size)
+        cards, stores = customer_cards(draw_customers(rng, n_customers, n_baskets, seed), starts, width)
+        # Later lines of a basket step through the product list, so a basket never holds a product twice
+        first = rng.choice(len(PRODUCTS), size=n_baskets, p=popularity / popularity.sum())
+        step = rng.integers(1, len(PRODUCTS) // max(BASKET_LINES) + 1, size=n_baskets)
+        product = (first[basket] + line * step[basket]) % len(PRODUCTS)
+        quantity = rng.choice(QUANTITIES, size=size, p=QUANTITY_SHARES)
+        chunk = pd.DataFrame({
+            'DATE': rng.choice(serials, size=n_baskets, p=weights)[basket],
+            'STORE_NBR': stores[basket],
+            'LYLTY_CARD_NBR': cards[basket],
+            'TXN_ID': baskets_written + basket + 1,
+            'PROD_NBR': product + 1,
+            'PROD_NAME': names[product],
+            'PROD_QTY': quantity,
+            'TOT_SALES': np.round(quantity * prices[product], 1)
+        })
+        if written == 0:
+            # The business purchase outliers and an exact duplicate row
+            chunk.loc[chunk.index[:2], 'PROD_QTY'] = 200
+            chunk.loc[chunk.index[:2], 'TOT_SALES'] = 650.0
+            chunk = pd.concat([chunk, chunk.iloc[[size // 2]]], ignore_index=True)
+        written += size
+        baskets_written += n_baskets
+        yield chunk
+
+
+def write_dataset(n_rows, out_dir, seed=0, chunksize=CHUNK_ROWS):
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    n_customers = max(1, int(n_rows / ROWS_PER_CUSTOMER))
+    starts, width = customer_layout(n_customers, rng)
+    customers_path = os.path.join(out_dir, "QVI_purchase_behaviour.csv")
+    for number, chunk in enumerate(iter_customers(n_customers, starts, width, rng, chunksize)):
+        chunk.to_csv(customers_path, mode='a' if number else 'w', header=not number, index=False)
+    transactions_path = os.path.join(out_dir, "QVI_transaction_data.csv")
+    for number, chunk in enumerate(iter_transactions(n_customers, starts, width, n_rows, rng, seed, chunksize)):
+        chunk.to_csv(transactions_path, mode='a' if number else 'w', header=not number, index=False)
+    return transactions_path
+
+
+if __name__ == '__main__':
+    write_dataset(int(float(sys.argv[1])), sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 0)
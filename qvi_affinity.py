@@ -0,0 +1,192 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from qvi_cache import CACHE_DIR, CUSTOMERS_PATH, FACTS_PATH, MERGED_DTYPES, cached_table, merged_sources
+from qvi_customers import CUSTOMER_COLUMNS, join_customers, load_customer_dimension
+
+
+# Brand and pack size affinity per customer segment, and products bought together.
+# One streaming pass over the transaction facts fills two sparse count matrices: units bought per
+# segment x brand (and segment x pack size), and which products each basket (transaction_id) holds.
+# Each chunk is reduced to its occupied cells before it is kept, so memory follows the number of
+# distinct (segment, brand) and (basket, product) pairs rather than the rows or a dense matrix.
+#
+# A segment's index for a brand is its share of the segment's units over the brand's share of all
+# units, times 100: above 100 the segment buys the brand more than customers overall. Co-purchase
+# pairs come from basket x product transposed times itself; lift is how much more often the two
+# products share a basket than they would by chance.
+
+AFFINITY_CHUNK_ROWS = 500_000
+AFFINITY_COLUMNS = ['loyalty_card_number', 'transaction_id', 'product_number', 'product_name', 'product_quantity', 'pack_size']
+AFFINITY_TABLES = ['brand', 'pack_size', 'pairs']
+AFFINITY_SCHEMA = 1
+# Segment codes are lifestage * SEGMENT_STRIDE + premium_customer while the vocabularies are still growing
+SEGMENT_STRIDE = 256
+
+
+def vocabulary_codes(vocabulary, column):
+    # Codes of a chunk's values in a vocabulary that grows as new values turn up, so codes agree across chunks
+    column = pd.Series(column)
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        column = column.astype('category')
+    categories = column.cat.categories
+    vocabulary = vocabulary.append(categories[~categories.isin(vocabulary)])
+    mapping = vocabulary.get_indexer(categories)
+    codes = column.cat.codes.to_numpy()
+    return np.where(codes < 0, -1, mapping[codes]), vocabulary
+
+
+def reduce_cells(rows, cols, weights=None):
+    # Sum duplicate (row, col) cells, so a chunk keeps one entry per occupied cell
+    cell = rows.astype(np.int64) << 32 | cols.astype(np.int64)
+    cells, inverse = np.unique(cell, return_inverse=True)
+    sums = np.bincount(inverse, weights=weights, minlength=len(cells))
+    return (cells >> 32).astype(np.int32), (cells & 0xFFFFFFFF).astype(np.int32), sums
+
+
+def sparse_counts(cells, shape):
+    # Chunks' reduced cells into one matrix, cells occupied in several chunks are summed by the conversion
+    from scipy.sparse import coo_matrix
+    rows, cols, sums = (np.concatenate([part[i] for part in cells]) if cells else np.empty(0, dtype=np.int64) for i in range(3))
+    return coo_matrix((sums, (rows, cols)), shape=shape).tocsr()
+
+
+def iter_fact_chunks(path=FACTS_PATH, customers_path=CUSTOMERS_PATH, cache_dir=CACHE_DIR, chunksize=AFFINITY_CHUNK_ROWS):
+    # Fact rows with the customer segment attached, chunk by chunk; merged_df.csv layouts carry the segment already
+    header = pd.read_csv(path, nrows=0).columns
+    lookup = [column for column in CUSTOMER_COLUMNS if column not in header]
+    columns = AFFINITY_COLUMNS + [column for column in CUSTOMER_COLUMNS if column in header]
+    dimension = load_customer_dimension(customers_path, cache_dir) if lookup else None
+    dtypes = {column: MERGED_DTYPES[column] for column in columns}
+    for chunk in pd.read_csv(path, usecols=columns, dtype=dtypes, chunksize=chunksize):
+        yield join_customers(chunk, dimension, lookup) if lookup else chunk
+
+
+def affinity_matrices(chunks):
+    # The single pass: segment x brand and segment x pack size units, and the basket x product incidence
+    vocabularies = {name: pd.Index([]) for name in CUSTOMER_COLUMNS + ['brand', 'pack_size']}
+    cells = {'brand': [], 'pack_size': [], 'basket': []}
+    products = []
+    for chunk in chunks:
+        codes = {}
+        for name, column in zip(CUSTOMER_COLUMNS + ['brand'], CUSTOMER_COLUMNS + ['product_name']):
+            codes[name], vocabularies[name] = vocabulary_codes(vocabularies[name], chunk[column])
+        pack_size = chunk['pack_size'].to_numpy()
+        has_pack_size = ~np.isnan(pack_size)
+        codes['pack_size'] = np.full(len(chunk), -1)
+        codes['pack_size'][has_pack_size], vocabularies['pack_size'] = vocabulary_codes(
+            vocabularies['pack_size'], pack_size[has_pack_size])
+        segment = codes['lifestage'].astype(np.int64) * SEGMENT_STRIDE + codes['premium_customer']
+        units = chunk['product_quantity'].to_numpy(dtype=float)
+        for name in ('brand', 'pack_size'):
+            keep = codes[name] >= 0
+            cells[name].append(reduce_cells(segment[keep], codes[name][keep], units[keep]))
+        # Baskets and products keep their own ids here and are numbered once every chunk is in
+        cells['basket'].append(reduce_cells(chunk['transaction_id'].to_numpy(), chunk['product_number'].to_numpy())[:2])
+        products.append(chunk[['product_number', 'product_name', 'pack_size']].drop_duplicates('product_number'))
+
+    segments = pd.MultiIndex.from_product([vocabularies['lifestage'], vocabularies['premium_customer']], names=CUSTOMER_COLUMNS)
+    matrices = {}
+    for name in ('brand', 'pack_size'):
+        # One row per (lifestage, premium_customer), as numbered by segments
+        reduced = [(rows // SEGMENT_STRIDE * len(vocabularies['premium_customer']) + rows % SEGMENT_STRIDE, cols, sums)
+                   for rows, cols, sums in cells[name]]
+        matrices[name] = sparse_counts(reduced, (len(segments), len(vocabularies[name])))
+    basket_ids, basket_rows = np.unique(np.concatenate([rows for rows, cols in cells['basket']]), return_inverse=True)
+    product_ids, product_cols = np.unique(np.concatenate([cols for rows, cols in cells['basket']]), return_inverse=True)
+    matrices['basket'] = sparse_counts([(basket_rows, product_cols, np.ones(len(basket_rows)))], (len(basket_ids), len(product_ids)))
+    # A product seen in several chunks of one basket is still one product in that basket
+    matrices['basket'].data[:] = 1
+    product_table = pd.concat(products).drop_duplicates('product_number').set_index('product_number')
+    return {
+        'matrices': matrices,
+        'segments': segments,
+        'brands': vocabularies['brand'].astype(str),
+        'pack_sizes': vocabularies['pack_size'].astype(float),
+        'products': product_table.reindex(product_ids)
+    }
+
+
+def affinity_index(counts, segments, values, name):
+    # Long table of each segment's share of a value against the value's share of all units
+    counts = counts.tocoo()
+    segment_units = np.asarray(counts.sum(axis=1)).ravel()
+    value_units = np.asarray(counts.sum(axis=0)).ravel()
+    population_share = value_units / value_units.sum()
+    share = counts.data / segment_units[counts.row]
+    table = pd.DataFrame({
+        'lifestage': segments.get_level_values('lifestage')[counts.row].astype(str),
+        'premium_customer': segments.get_level_values('premium_customer')[counts.row].astype(str),
+        name: np.asarray(values)[counts.col],
+        'units': counts.data,
+        'share': share,
+        'population_share': population_share[counts.col],
+        'index': 100 * share / population_share[counts.col]
+    })
+    return table.sort_values(['lifestage', 'premium_customer', 'index'], ascending=[True, True, False], ignore_index=True)
+
+
+def co_purchase_pairs(baskets, products, min_baskets=1):
+    # Every pair of products sharing at least min_baskets baskets, with support, confidence both ways and lift
+    item_baskets = np.asarray(baskets.sum(axis=0)).ravel()
+    n_baskets = baskets.shape[0]
+    # Only baskets with two or more products can hold a pair
+    multi = baskets[np.flatnonzero(np.diff(baskets.indptr) > 1)]
+    together = (multi.T @ multi).tocoo()
+    upper = (together.row < together.col) & (together.data >= min_baskets)
+    first, second, shared = together.row[upper], together.col[upper], together.data[upper]
+    table = pd.DataFrame({
+        'first_product': products.index.to_numpy()[first],
+        'first_brand': products['product_name'].astype(str).to_numpy()[first],
+        'first_pack_size': products['pack_size'].to_numpy()[first],
+        'second_product': products.index.to_numpy()[second],
+        'second_brand': products['product_name'].astype(str).to_numpy()[second],
+        'second_pack_size': products['pack_size'].to_numpy()[second],
+        'baskets': shared.astype(np.int64),
+        'support': shared / n_baskets,
+        'confidence_first': shared / item_baskets[first],
+        'confidence_second': shared / item_baskets[second],
+        'lift': shared * n_baskets / (item_baskets[first] * item_baskets[second])
+    })
+    return table.sort_values(['lift', 'baskets'], ascending=False, ignore_index=True)
+
+
+def affinity_tables(path=FACTS_PATH, customers_path=CUSTOMERS_PATH, cache_dir=CACHE_DIR, chunksize=AFFINITY_CHUNK_ROWS):
+    counted = affinity_matrices(iter_fact_chunks(path, customers_path, cache_dir, chunksize))
+    matrices = counted['matrices']
+    return {
+        'brand': affinity_index(matrices['brand'], counted['segments'], counted['brands'], 'brand'),
+        'pack_size': affinity_index(matrices['pack_size'], counted['segments'], counted['pack_sizes'], 'pack_size'),
+        'pairs': co_purchase_pairs(matrices['basket'], counted['products'])
+    }
+
+
+def segment_affinity(path=FACTS_PATH, customers_path=CUSTOMERS_PATH, cache_dir=CACHE_DIR):
+    # Cached affinity tables, one streaming pass over the facts builds all of them whenever any is stale
+    sources = merged_sources(path)
+    built = {}
+
+    def build(name):
+        if not built:
+            built.update(affinity_tables(path, customers_path, cache_dir))
+        table = built[name]
+        text = [column for column in table.columns if pd.api.types.is_string_dtype(table[column].dtype)]
+        return table.astype({column: 'category' for column in text})
+    return {name: cached_table(os.path.join(cache_dir, "affinity_" + name), sources, lambda name=name: build(name), AFFINITY_SCHEMA, mmap=False)
+            for name in AFFINITY_TABLES}
+
+
+def top_affinities(table, name, top=3, min_share=0.01):
+    # Each segment's most over-indexed values, ignoring values too small a share of the segment to matter
+    table = table[table['share'] >= min_share]
+    return table.groupby(['lifestage', 'premium_customer'], observed=True, sort=True).head(top)[['lifestage', 'premium_customer', name, 'share', 'index']]
+
+
+if __name__ == '__main__':
+    affinity = segment_affinity()
+    with pd.option_context('display.width', 200, 'display.max_columns', 20, 'display.max_rows', 200):
+        print(top_affinities(affinity['brand'], 'brand').to_string(index=False))
+        print(top_affinities(affinity['pack_size'], 'pack_size').to_string(index=False))
+        print(affinity['pairs'].head(20).to_string(index=False))
@@ -0,0 +1,231 @@
+import filecmp
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from qvi_cache import CUSTOMERS_PATH, FACTS_PATH, sales_cents, source_fingerprint
+
+
+# Running monthly aggregates per (lifestage, premium_customer, month) segment.
+# The state keeps the transaction count, the sum of sales and the sum of squared sales, so new
+# days of transactions can be merged in without rescanning the history, and totals, means and
+# variances can all be derived from it. Sales are held in integer cents, which makes the sums
+# independent of the order batches arrive in: appending day by day gives exactly the same
+# state, and the same report CSVs, as building it from the full history in one go; check_incremental
+# (python qvi_aggregates.py --check) verifies that on the current data.
+# Newly landed batch files are merged with append_batch and recorded by content hash, so every row of
+# a new batch counts and no batch counts twice. update_state brings the state up to date with the full
+# history and only aggregates the rows after the last date it holds. The segments come from the customer
+# file, so the state records its fingerprint and is rebuilt when customers are re-segmented
+# (python qvi_aggregates.py --check covers that case too).
+
+STATE_PATH = os.path.join(".qvi_cache", "segment_month_state.json")
+SEGMENT_KEYS = ['lifestage', 'premium_customer', 'month']
+STATE_COLUMNS = ['count', 'sales_cents', 'sales_cents_sq']
+
+
+def month_key(dates):
+    return (dates.dt.year * 100 + dates.dt.month).astype(str)
+
+
+def segment_month_state(frame):
+    cents = sales_cents(frame['total_sales'])
+    batch = pd.DataFrame({
+        'lifestage': np.asarray(frame['lifestage'], dtype=object),
+        'premium_customer': np.asarray(frame['premium_customer'], dtype=object),
+        'month': month_key(frame['date']).to_numpy(dtype=object),
+        'count': np.ones(len(frame), dtype=np.int64),
+        'sales_cents': cents,
+        'sales_cents_sq': cents * cents
+    })
+    return batch.groupby(SEGMENT_KEYS)[STATE_COLUMNS].sum().reset_index()
+
+
+def merge_states(*states):
+    return pd.concat(states, ignore_index=True).groupby(SEGMENT_KEYS)[STATE_COLUMNS].sum().reset_index()
+
+
+def empty_state():
+    return pd.DataFrame({column: pd.Series(dtype=object) for column in SEGMENT_KEYS} |
+                        {column: pd.Series(dtype=np.int64) for column in STATE_COLUMNS})
+
+
+def load_state(path=STATE_PATH):
+    # The state and what it covers: the last transaction date, the source it was built from and the batches merged since
+    if not os.path.exists(path):
+        return empty_state(), {'through': None, 'source': None, 'batches': []}
+    with open(path) as f:
+        stored = json.load(f)
+    state = pd.DataFrame(stored['segments'], columns=SEGMENT_KEYS + STATE_COLUMNS)
+    meta = {'through': stored['through'], 'source': stored.get('source'), 'batches': stored.get('batches', [])}
+    return state.astype({column: np.int64 for column in STATE_COLUMNS}), meta
+
+
+def save_state(state, meta, path=STATE_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({**meta, 'segments': state[SEGMENT_KEYS + STATE_COLUMNS].values.tolist()}, f)
+    os.replace(tmp_path, path)
+
+
+def batch_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def state_source(path=FACTS_PATH, customers_path=CUSTOMERS_PATH):
+    # What the state is built from: the facts file, which grows as days land and is checked against the state
+    # row by row, and the fingerprint of the customer file whose segments every row is counted under
+    return {'facts': path, 'customers': source_fingerprint([customers_path])}
+
+
+def update_state(frame, path=STATE_PATH, source=None):
+    # Bring the state up to date with frame, the full history of source (see state_source). Only rows
+    # dated after the watermark are aggregated; the rows at or before it have to add up to the count and
+    # cents the state already holds. Late rows or a re-cleansed source fail that check and the state is
+    # rebuilt, as it is when there is no state yet or it was built from another source or customer file.
+    state, meta = load_state(path)
+    if meta['through'] is None or meta['source'] != source:
+        return rebuild_state(frame, path, source)
+    new = (frame['date'] > pd.Timestamp(meta['through'])).to_numpy()
+    held_count, held_cents = state['count'].sum(), state['sales_cents'].sum()
+    if np.count_nonzero(~new) != held_count or sales_cents(frame['total_sales'].to_numpy()[~new]).sum() != held_cents:
+        warnings.warn(f"{source} differs from the segment state at or before {meta['through']}, rebuilding it")
+        return rebuild_state(frame, path, source)
+    if new.any():
+        frame = frame[new]
+        state = merge_states(state, segment_month_state(frame))
+        save_state(state, {**meta, 'through': str(frame['date'].max().date())}, path)
+    return state
+
+
+def append_batch(frame, batch_id, path=STATE_PATH):
+    # Merge a newly landed batch of transactions, whatever their dates, so late rows, a second batch for
+    # the same day and batches passed out of order all count. Batches are recorded by batch_id, the
+    # content hash of the batch file, and a batch that was already merged is skipped.
+    state, meta = load_state(path)
+    if batch_id in meta['batches']:
+        warnings.warn(f"Batch {batch_id} was already merged into the segment state, skipping it")
+        return state
+    if len(frame):
+        state = merge_states(state, segment_month_state(frame))
+        last = str(frame['date'].max().date())
+        meta['through'] = last if meta['through'] is None else max(meta['through'], last)
+    save_state(state, {**meta, 'batches': meta['batches'] + [batch_id]}, path)
+    return state
+
+
+def rebuild_state(frame, path=STATE_PATH, source=None):
+    state = segment_month_state(frame)
+    save_state(state, {'through': str(frame['date'].max().date()), 'source': source, 'batches': []}, path)
+    return state
+
+
+def check_incremental(frame):
+    # Append frame one day at a time into a scratch state and compare the state and the report CSVs
+    # with a full rebuild; returns the names of whatever differs, empty when they all match
+    with tempfile.TemporaryDirectory(prefix="qvi_state_check_") as tmp:
+        full = rebuild_state(frame, os.path.join(tmp, "full.json"))
+        daily_path = os.path.join(tmp, "daily.json")
+        for day, batch in frame.groupby(frame['date'].dt.normalize(), sort=True):
+            daily = append_batch(batch, str(day.date()), daily_path)
+        mismatches = []
+        if not full.sort_values(SEGMENT_KEYS, ignore_index=True).equals(daily.sort_values(SEGMENT_KEYS, ignore_index=True)):
+            mismatches.append('state')
+        write_monthly_reports(full, os.path.join(tmp, "full"))
+        write_monthly_reports(daily, os.path.join(tmp, "daily"))
+        for name in sorted(os.listdir(os.path.join(tmp, "full"))):
+            if not filecmp.cmp(os.path.join(tmp, "full", name), os.path.join(tmp, "daily", name), shallow=False):
+                mismatches.append(name)
+    return mismatches
+
+
+def check_resegmented(frame, customers_path=CUSTOMERS_PATH):
+    # Build a scratch state against a copy of the customer file, move every customer to the next premium
+    # segment in that copy and check update_state then matches a full rebuild of the re-segmented data
+    from qvi_customers import CUSTOMER_COLUMNS, customer_dimension, join_customers, read_customers
+    with tempfile.TemporaryDirectory(prefix="qvi_state_check_") as tmp:
+        state_path = os.path.join(tmp, "state.json")
+        copy_path = os.path.join(tmp, os.path.basename(customers_path))
+        customers = pd.read_csv(customers_path)
+        customers.to_csv(copy_path, index=False)
+        update_state(frame, state_path, state_source(customers_path=copy_path))
+        customers['PREMIUM_CUSTOMER'] = np.roll(customers['PREMIUM_CUSTOMER'].to_numpy(), 1)
+        customers.to_csv(copy_path, index=False)
+        resegmented = join_customers(frame.drop(columns=CUSTOMER_COLUMNS), customer_dimension(read_customers(copy_path)))
+        updated = update_state(resegmented, state_path, state_source(customers_path=copy_path))
+        full = segment_month_state(resegmented)
+    return updated.sort_values(SEGMENT_KEYS, ignore_index=True).equals(full.sort_values(SEGMENT_KEYS, ignore_index=True))
+
+
+def monthly_sales(state, keys):
+    # Roll the segment state up to keys + month and derive total, mean and variance of sales
+    rolled = state.groupby(keys + ['month'])[STATE_COLUMNS].sum().reset_index()
+    count = rolled['count'].to_numpy(dtype=float)
+    total = rolled['sales_cents'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        variance = (rolled['sales_cents_sq'].to_numpy(dtype=float) - total * mean) / (count - 1)
+    rolled['total_sales'] = total / 100
+    rolled['mean_sales'] = mean / 100
+    rolled['var_sales'] = variance / 100 ** 2
+    return rolled
+
+
+def monthly_tables(state):
+    # The monthly report tables: sales per spending type, per lifestage and per lifestage x spending type
+    tables = {
+        'spending_type': monthly_sales(state, ['premium_customer']),
+        'lifestage': monthly_sales(state, ['lifestage']),
+        'customer_type': monthly_sales(state, ['lifestage', 'premium_customer'])
+    }
+    tables['customer_type']['cust_type'] = tables['customer_type']['lifestage'] + ' - ' + tables['customer_type']['premium_customer']
+    return tables
+
+
+def write_monthly_tables(tables, out_dir="."):
+    # The lifestage only totals used to be written to sales_lifestage.csv and then overwritten by the
+    # lifestage x premium_customer totals, which kept the name; they now have their own file
+    os.makedirs(out_dir, exist_ok=True)
+    tables['spending_type'][['premium_customer', 'month', 'total_sales']].to_csv(
+        os.path.join(out_dir, "sales_customer_spending_type.csv"), index=False)
+    tables['lifestage'][['lifestage', 'month', 'total_sales']].to_csv(os.path.join(out_dir, "sales_lifestage_total.csv"), index=False)
+    tables['customer_type'][['lifestage', 'premium_customer', 'month', 'total_sales', 'cust_type']].to_csv(
+        os.path.join(out_dir, "sales_lifestage.csv"), index=False)
+
+
+def write_monthly_reports(state, out_dir="."):
+    write_monthly_tables(monthly_tables(state), out_dir)
+
+
+if __name__ == '__main__':
+    # python qvi_aggregates.py new_day.csv [...] merges newly landed transaction batches, in the
+    # transaction facts or merged_df.csv layout, into the stored state and rewrites the monthly report CSVs.
+    # python qvi_aggregates.py --check appends the merged data day by day and compares it with a full rebuild,
+    # then checks a re-segmented customer file makes update_state rebuild
+    if sys.argv[1:] == ['--check']:
+        from qvi_cache import load_merged
+        frame = load_merged(columns=['loyalty_card_number', 'lifestage', 'premium_customer', 'date', 'total_sales'])
+        mismatches = check_incremental(frame)
+        print("Day by day state matches the full rebuild" if not mismatches else f"Day by day state differs from the full rebuild: {mismatches}")
+        resegmented = check_resegmented(frame)
+        print("Re-segmented state matches the full rebuild" if resegmented else "Re-segmented state differs from the full rebuild")
+        sys.exit(1 if mismatches or not resegmented else 0)
+    from qvi_cache import read_merged_csv
+    from qvi_customers import CUSTOMER_COLUMNS, join_customers, load_customer_dimension
+    for batch_path in sys.argv[1:]:
+        batch = read_merged_csv(batch_path)
+        if not set(CUSTOMER_COLUMNS).issubset(batch.columns):
+            batch = join_customers(batch, load_customer_dimension())
+        append_batch(batch, batch_digest(batch_path))
+    write_monthly_reports(load_state()[0])
@@ -0,0 +1,248 @@
+import itertools
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+# Typed columnar cache of the cleansed transaction facts, and of the raw transaction workbook.
+# Each column is stored as its own .npy file so later runs can memory-map it and
+# only touch the columns they ask for. Categoricals are stored as codes with the
+# categories kept in the manifest. The merged view of the data is the cached facts joined to the
+# customer dimension in qvi_customers as it is loaded.
+# Every cached table goes through cached_table, which rebuilds it when its sources change, when the
+# storage format (CACHE_VERSION) changes or when the table's own schema version changes, so changing
+# one table's layout only invalidates that table.
+
+CACHE_DIR = ".qvi_cache"
+CACHE_VERSION = 4
+FACTS_SCHEMA = 1
+TRANSACTIONS_SCHEMA = 1
+
+FACTS_PATH = "QVI_transaction_facts.csv"
+CUSTOMERS_PATH = "QVI_purchase_behaviour.csv"
+
+# Files the merged data is derived from, a change to any of them invalidates the cache
+SOURCE_FILES = [FACTS_PATH, "QVI_transaction_data.xlsx", CUSTOMERS_PATH]
+
+# Compact schema for the merged data: text as categoricals, ids and quantities in the smallest int that
+# holds the values read, and money as float32. Integer columns are read as int64 and narrowed by
+# narrow_integers, so a wider store, product or card number range widens the column instead of
+# wrapping round, and a value past int64 fails the read. float32 only carries about 7 significant
+# digits, so anything that adds sales up goes through sales_cents first to get exact cent amounts back.
+MERGED_DTYPES = {
+    'loyalty_card_number': 'int64',
+    'lifestage': 'category',
+    'premium_customer': 'category',
+    'store_number': 'int64',
+    'transaction_id': 'int64',
+    'product_number': 'int64',
+    'product_name': 'category',
+    'product_quantity': 'int64',
+    'total_sales': 'float32',
+    'pack_size': 'float32'
+}
+
+# Raw workbook columns; DATE stays an Excel serial day number until cleansing decodes it. Integers are
+# narrowed the same way, block by block as the sheet streams in
+TRANSACTION_DTYPES = {
+    'DATE': 'int64',
+    'STORE_NBR': 'int64',
+    'LYLTY_CARD_NBR': 'int64',
+    'TXN_ID': 'int64',
+    'PROD_NBR': 'int64',
+    'PROD_NAME': 'category',
+    'PROD_QTY': 'int64',
+    'TOT_SALES': 'float64'
+}
+WORKBOOK_CHUNK_ROWS = 100_000
+
+
+def source_fingerprint(paths):
+    fingerprint = {}
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprint[path] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+
+def narrow_integers(frame):
+    # Every integer column in the smallest signed int that holds its values
+    return frame.assign(**{name: pd.to_numeric(frame[name], downcast='integer')
+                           for name in frame.columns if pd.api.types.is_integer_dtype(frame[name].dtype)})
+
+
+def read_merged_csv(path=FACTS_PATH):
+    return narrow_integers(pd.read_csv(path, dtype=MERGED_DTYPES, parse_dates=['date']))
+
+
+def sales_cents(values):
+    # Sales rounded back to whole cents, exact whatever float width they were stored in
+    return np.rint(np.asarray(values, dtype=float) * 100).astype(np.int64)
+
+
+def bytes_per_row(frame):
+    return frame.memory_usage(index=False, deep=True).sum() / max(len(frame), 1)
+
+
+def memory_report(path=FACTS_PATH, customers_path=CUSTOMERS_PATH):
+    # Bytes per row of the merged data as read by default, after convert_dtypes() as QVI.py used to, and in the compact schema
+    # Customer attributes are only joined on when the file doesn't carry them already, as in load_merged
+    from qvi_customers import CUSTOMER_COLUMNS, customer_dimension, join_customers, new_QVI_purchase_names, read_customers
+    default = pd.read_csv(path)
+    compact = read_merged_csv(path)
+    lookup = [column for column in CUSTOMER_COLUMNS if column not in default.columns]
+    if lookup:
+        customers = pd.read_csv(customers_path).rename(columns=new_QVI_purchase_names)
+        default = customers[['loyalty_card_number'] + lookup].merge(default, on='loyalty_card_number')
+        compact = join_customers(compact, customer_dimension(read_customers(customers_path)), lookup)
+    frames = {
+        'default': default,
+        'convert_dtypes': default.convert_dtypes(),
+        'compact': compact
+    }
+    report = pd.DataFrame({
+        'bytes_per_row': {name: bytes_per_row(frame) for name, frame in frames.items()},
+        'total_mb': {name: frame.memory_usage(index=False, deep=True).sum() / 2**20 for name, frame in frames.items()}
+    })
+    report['vs_default'] = report['bytes_per_row'] / report.loc['default', 'bytes_per_row']
+    columns = pd.DataFrame({name: frame.memory_usage(index=False, deep=True) / max(len(frame), 1) for name, frame in frames.items()})
+    return report, columns
+
+
+def write_columns(frame, cache_path, sources, schema=1):
+    # Build the cache next to its final location and swap it in, so a crashed run never leaves half a cache
+    tmp_path = cache_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    columns = {}
+    for name in frame.columns:
+        column = frame[name]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            values = column.cat.codes.to_numpy()
+            columns[name] = {'dtype': 'category', 'categories': column.cat.categories.tolist()}
+        elif pd.api.types.is_datetime64_dtype(column.dtype):
+            values = column.to_numpy(dtype='datetime64[ns]')
+            columns[name] = {'dtype': 'datetime64[ns]'}
+        else:
+            values = column.to_numpy()
+            columns[name] = {'dtype': str(values.dtype)}
+        np.save(os.path.join(tmp_path, name + ".npy"), values, allow_pickle=False)
+    manifest = {'version': CACHE_VERSION, 'schema': schema, 'sources': sources, 'rows': len(frame), 'columns': columns}
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.replace(tmp_path, cache_path)
+
+
+def read_manifest(cache_path):
+    try:
+        with open(os.path.join(cache_path, "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_columns(cache_path, manifest, columns=None, mmap=True):
+    names = list(manifest['columns']) if columns is None else list(columns)
+    data = {}
+    for name in names:
+        spec = manifest['columns'][name]
+        values = np.load(os.path.join(cache_path, name + ".npy"), mmap_mode='r' if mmap else None)
+        if spec['dtype'] == 'category':
+            data[name] = pd.Categorical.from_codes(values, categories=spec['categories'])
+        else:
+            data[name] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def cached_manifest(cache_path, sources, build, schema):
+    # Manifest of the table cached at cache_path, writing build() there first when the cache is missing or stale
+    manifest = read_manifest(cache_path)
+    if (manifest is None or manifest['version'] != CACHE_VERSION or manifest.get('schema') != schema
+            or manifest['sources'] != sources):
+        write_columns(build(), cache_path, sources, schema)
+        manifest = read_manifest(cache_path)
+    return manifest
+
+
+def cached_table(cache_path, sources, build, schema, columns=None, mmap=True):
+    # The table cached at cache_path, built by build() whenever it is missing or stale
+    return read_columns(cache_path, cached_manifest(cache_path, sources, build, schema), columns, mmap)
+
+
+def merged_sources(path=FACTS_PATH):
+    return source_fingerprint([path] + [p for p in SOURCE_FILES if p != path])
+
+
+def load_merged(columns=None, path=FACTS_PATH, customers_path=CUSTOMERS_PATH, cache_dir=CACHE_DIR, mmap=True):
+    # Load the merged dataset, parsing the CSV only when the cache is missing or stale. Customer
+    # attributes the file doesn't carry are looked up in the customer dimension, and only when asked for
+    from qvi_customers import CUSTOMER_COLUMNS, join_customers, load_customer_dimension
+    cache_path = os.path.join(cache_dir, "facts")
+    manifest = cached_manifest(cache_path, merged_sources(path), lambda: read_merged_csv(path), FACTS_SCHEMA)
+    stored = list(manifest['columns'])
+    lookup = [column for column in CUSTOMER_COLUMNS if column not in stored]
+    if columns is None:
+        # Customer attributes sit after the card number, as in merged_df.csv
+        columns = stored[:1] + lookup + stored[1:]
+    lookup = [column for column in lookup if column in columns]
+    read = [column for column in columns if column in stored]
+    if lookup and 'loyalty_card_number' not in read:
+        read.append('loyalty_card_number')
+    frame = read_columns(cache_path, manifest, read, mmap)
+    if lookup:
+        frame = join_customers(frame, load_customer_dimension(customers_path, cache_dir), lookup)
+    return frame[list(columns)]
+
+
+def read_workbook(path, chunksize=WORKBOOK_CHUNK_ROWS):
+    # Stream the sheet with openpyxl's read-only reader straight into typed arrays, product names
+    # are coded against one growing name table so no per-row strings are kept
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = list(next(rows))
+        parts = {name: [] for name in header}
+        names = {}
+        while True:
+            block = list(itertools.islice(rows, chunksize))
+            if not block:
+                break
+            for name, values in zip(header, zip(*block)):
+                if TRANSACTION_DTYPES[name] == 'category':
+                    codes, uniques = pd.factorize(np.array(values, dtype=object))
+                    table = np.array([names.setdefault(value, len(names)) for value in uniques], dtype=np.int32)
+                    parts[name].append(table[codes])
+                elif TRANSACTION_DTYPES[name] == 'int64':
+                    # Concatenating the blocks widens the column to the widest block
+                    parts[name].append(pd.to_numeric(np.array(values, dtype=np.int64), downcast='integer'))
+                else:
+                    parts[name].append(np.array(values, dtype=TRANSACTION_DTYPES[name]))
+    finally:
+        workbook.close()
+    columns = {}
+    for name in header:
+        values = np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=np.int32)
+        if TRANSACTION_DTYPES[name] == 'category':
+            values = pd.Categorical.from_codes(values, categories=list(names))
+        columns[name] = values
+    return pd.DataFrame(columns)
+
+
+def load_transactions(path="QVI_transaction_data.xlsx", columns=None, cache_dir=CACHE_DIR, mmap=True):
+    # Raw transactions from the workbook, converted once and memory-mapped from the cache afterwards
+    cache_path = os.path.join(cache_dir, "transactions")
+    return cached_table(cache_path, source_fingerprint([path]), lambda: read_workbook(path), TRANSACTIONS_SCHEMA, columns, mmap)
+
+
+if __name__ == '__main__':
+    # Memory footprint of the merged data in the compact schema, per row and per column
+    import sys
+    report, columns = memory_report(*sys.argv[1:3])
+    print(report.round(2))
+    print(columns.round(2))
@@ -0,0 +1,286 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from qvi_cache import load_transactions
+from qvi_customers import customer_dimension, customer_positions, join_customers, read_customers
+from qvi_stages import new_run, run_peak_rss_mb, stage
+
+
+# Streaming version of the QVI.py data cleansing.
+# The customer table is small and is held in memory as the customer dimension keyed by loyalty card
+# number, the transactions are read in chunks and every chunk flows through dedup, outlier removal,
+# date conversion, salsa filtering, pack size / brand lookup and the customer lookup before being
+# appended to the output. Only small running aggregates are kept between chunks.
+# The output is the transaction facts without the customer attributes, later scripts join those back
+# from the customer dimension. The denormalised merged_df.csv is only written when asked for.
+# The workbook is converted once into the typed columnar cache and chunks are sliced from there.
+# The cleansed transactions are written as CSV, the XLSX copy is only written when asked for.
+#
+# Exact duplicates are found in a pass of their own before the chunks flow through: every row's
+# 64 bit hash and row number are spilled to one of DEDUP_PARTITIONS files picked by the hash, so
+# equal rows always share a file, and each file is searched for repeated hashes on its own. Rows
+# sharing a hash are then read back and compared value by value, so a hash collision never drops a
+# distinct transaction. Memory is bounded by one chunk, one partition (16 bytes per row /
+# DEDUP_PARTITIONS) and the rows whose hash repeats; the spill takes 16 bytes per row of temporary disk.
+
+CHUNK_ROWS = 500_000
+DEDUP_PARTITIONS = 256
+SPILL_DTYPE = np.dtype([('hash', np.uint64), ('row', np.int64)])
+
+new_QVI_transaction_names = {
+    "DATE": "date",
+    "STORE_NBR": "store_number",
+    "LYLTY_CARD_NBR": "loyalty_card_number",
+    "TXN_ID": "transaction_id",
+    "PROD_NBR": "product_number",
+    "PROD_NAME": "product_name",
+    "PROD_QTY": "product_quantity",
+    "TOT_SALES": "total_sales"
+}
+
+FACT_COLUMNS = [
+    'loyalty_card_number', 'date', 'store_number', 'transaction_id',
+    'product_number', 'product_name', 'product_quantity', 'total_sales', 'pack_size'
+]
+MERGED_COLUMNS = FACT_COLUMNS[:1] + ['lifestage', 'premium_customer'] + FACT_COLUMNS[1:]
+
+# First word of the product name -> brand, for the brands that are spelt more than one way
+BRAND_ALIASES = {
+    'Red': 'RRD',
+    'Smith': 'Smiths',
+    'Dorito': 'Doritos',
+    'Snbts': 'Sunbites',
+    'Infzns': 'Infuzions',
+    'WW': 'Woolworths',
+    'NCC': 'Natural',
+    'Grain': 'GrnWves'
+}
+
+# 200 packets in a single purchase, looks like a business purchase
+OUTLIER_QUANTITY = 200
+
+# Days between the Excel epoch (1899-12-30) and the Unix epoch
+EXCEL_UNIX_OFFSET = 25569
+
+
+def iter_transaction_chunks(path, chunksize=CHUNK_ROWS):
+    if path.endswith('.csv'):
+        yield from pd.read_csv(path, chunksize=chunksize)
+        return
+    transactions = load_transactions(path)
+    for start in range(0, len(transactions), chunksize):
+        yield transactions.iloc[start:start + chunksize]
+
+
+def excel_dates(serials):
+    # Whole-day Excel serial numbers to datetime64 with integer arithmetic
+    days = np.asarray(serials, dtype=np.int64) - EXCEL_UNIX_OFFSET
+    return days.astype('datetime64[D]').astype('datetime64[ns]')
+
+
+def duplicate_rows(read_chunks, partitions=DEDUP_PARTITIONS, spill_dir=None):
+    # Sorted row numbers of every row that repeats an earlier row exactly, over all chunks. read_chunks
+    # returns a fresh iterator over the chunks, they are read a second time for the rows whose hash repeats
+    with tempfile.TemporaryDirectory(prefix="qvi_dedup_", dir=spill_dir) as tmp:
+        paths = [os.path.join(tmp, f"{partition}.bin") for partition in range(partitions)]
+        files = [open(path, "wb") for path in paths]
+        try:
+            start = 0
+            for chunk in read_chunks():
+                records = np.empty(len(chunk), dtype=SPILL_DTYPE)
+                records['hash'] = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+                records['row'] = np.arange(start, start + len(chunk))
+                start += len(chunk)
+                # Stable sort by partition keeps every partition file in row order
+                partition = (records['hash'] % np.uint64(partitions)).astype(np.int64)
+                order = np.argsort(partition, kind='stable')
+                bounds = np.searchsorted(partition[order], np.arange(partitions + 1))
+                records = records[order]
+                for part in np.flatnonzero(np.diff(bounds)):
+                    files[part].write(records[bounds[part]:bounds[part + 1]].tobytes())
+        finally:
+            for f in files:
+                f.close()
+        candidates = []
+        for path in paths:
+            records = np.fromfile(path, dtype=SPILL_DTYPE)
+            # Every row whose hash turns up more than once, the first of them included
+            candidates.append(records['row'][pd.Series(records['hash']).duplicated(keep=False).to_numpy()])
+            os.remove(path)
+    candidates = np.sort(np.concatenate(candidates))
+    if not len(candidates):
+        return candidates
+    rows, start = [], 0
+    for chunk in read_chunks():
+        first, last = np.searchsorted(candidates, [start, start + len(chunk)])
+        rows.append(chunk.iloc[candidates[first:last] - start])
+        start += len(chunk)
+        if start > candidates[-1]:
+            break
+    # Equal rows always hash alike, so comparing the candidates' values finds every duplicate; rows are
+    # in row order, so the first of each is the one kept
+    return candidates[pd.concat(rows, ignore_index=True).duplicated().to_numpy()]
+
+
+def drop_duplicate_rows(chunk, start, duplicates):
+    # Drop the rows of a chunk starting at row number start that duplicate_rows listed
+    first, last = np.searchsorted(duplicates, [start, start + len(chunk)])
+    keep = np.ones(len(chunk), dtype=bool)
+    keep[duplicates[first:last] - start] = False
+    return chunk[keep]
+
+
+def product_dimension(product_names):
+    # Parse each distinct product name once into brand, pack size and salsa flag
+    names = pd.Series(product_names, dtype=object)
+    first_word = names.str.split().str.get(0)
+    return pd.DataFrame({
+        'brand': first_word.map(lambda word: BRAND_ALIASES.get(word, word)).to_numpy(),
+        'pack_size': names.str.extract(r'(\d+)', expand=False).astype(float).to_numpy(),
+        'is_salsa': names.str.contains('Salsa').to_numpy()
+    }, index=pd.Index(product_names, name='product_name'))
+
+
+def apply_product_dimension(chunk):
+    # Drop salsa and replace product names with brand and pack size, doing the string work per
+    # distinct product and mapping it back onto the rows through the factorized codes
+    codes, names = pd.factorize(chunk['product_name'])
+    products = product_dimension(names)
+    keep = ~products['is_salsa'].to_numpy()[codes]
+    codes = codes[keep]
+    brand_codes, brands = pd.factorize(products['brand'])
+    return chunk[keep].assign(
+        product_name=pd.Categorical.from_codes(brand_codes[codes], brands).remove_unused_categories(),
+        pack_size=products['pack_size'].to_numpy()[codes]
+    )
+
+
+def open_excel_writer(columns):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(list(columns))
+    return workbook, sheet
+
+
+def cleanse_transactions(transactions_path="QVI_transaction_data.xlsx", customers_path="QVI_purchase_behaviour.csv",
+                         facts_path="QVI_transaction_facts.csv", customers_out="QVI_purchase_cleansed.csv",
+                         transactions_out="QVI_transaction_data_cleansed.csv", excel_out=None, merged_path=None,
+                         chunksize=CHUNK_ROWS, run=None, spill_dir=None):
+    # Every step is a named stage of run, summed over the chunks, so the report shows where the time and memory went.
+    # The dedup spill goes to a temporary directory under spill_dir, the system default when None
+    start = time.perf_counter()
+    run = run if run is not None else new_run('cleanse')
+    with stage(run, 'customers') as record:
+        customers = read_customers(customers_path)
+        customers.to_csv(customers_out, index=False)
+        dimension = customer_dimension(customers)
+        record['rows_out'] = len(dimension)
+
+    with stage(run, 'ingest') as record:
+        # The workbook is converted into the typed column cache here, later stages only read the cache
+        if not transactions_path.endswith('.csv'):
+            record['rows_out'] = len(load_transactions(transactions_path))
+    with stage(run, 'dedup_scan') as record:
+        duplicates = duplicate_rows(lambda: iter_transaction_chunks(transactions_path, chunksize), spill_dir=spill_dir)
+        record['rows_out'] = len(duplicates)
+    daily_counts = pd.Series(dtype='int64')
+    brand_counts = pd.Series(dtype='int64')
+    pack_size_counts = pd.Series(dtype='int64')
+    rows_in = rows_out = rows_written = 0
+    workbook = sheet = None
+    chunks = iter_transaction_chunks(transactions_path, chunksize)
+    while True:
+        with stage(run, 'load') as record:
+            chunk = next(chunks, None)
+            record['rows_out'] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            break
+        with stage(run, 'dedup', len(chunk)) as record:
+            chunk = drop_duplicate_rows(chunk.rename(columns=new_QVI_transaction_names), rows_in, duplicates)
+            record['rows_out'] = len(chunk)
+        rows_in += record['rows_in']
+        with stage(run, 'outliers', len(chunk)) as record:
+            chunk = chunk[chunk['product_quantity'] != OUTLIER_QUANTITY]
+            record['rows_out'] = len(chunk)
+        with stage(run, 'dates', len(chunk)) as record:
+            chunk = chunk.assign(date=excel_dates(chunk['date']))
+            # Daily transaction counts include salsa, as in the original date plots
+            daily_counts = daily_counts.add(chunk['date'].value_counts(), fill_value=0)
+            record['rows_out'] = len(chunk)
+        with stage(run, 'export_transactions', len(chunk)) as record:
+            if transactions_out:
+                chunk.to_csv(transactions_out, mode='a' if rows_written else 'w', header=not rows_written, index=False)
+                rows_written += len(chunk)
+            if excel_out:
+                if workbook is None:
+                    workbook, sheet = open_excel_writer(chunk.columns)
+                for row in chunk.itertuples(index=False):
+                    sheet.append(list(row))
+            record['rows_out'] = len(chunk)
+
+        with stage(run, 'product_cleanup', len(chunk)) as record:
+            chunk = apply_product_dimension(chunk)
+            brand_counts = brand_counts.add(chunk['product_name'].value_counts(), fill_value=0)
+            pack_size_counts = pack_size_counts.add(chunk['pack_size'].value_counts(), fill_value=0)
+            record['rows_out'] = len(chunk)
+
+        with stage(run, 'customer_join', len(chunk)) as record:
+            # Only transactions from known customers are kept, as with the inner merge
+            found = customer_positions(dimension, chunk['loyalty_card_number'])[1]
+            facts = chunk[found][FACT_COLUMNS]
+            record['rows_out'] = len(facts)
+        with stage(run, 'export_facts', len(facts)) as record:
+            facts.to_csv(facts_path, mode='a' if rows_out else 'w', header=not rows_out, index=False)
+            if merged_path:
+                merged = join_customers(facts, dimension)[MERGED_COLUMNS]
+                merged.to_csv(merged_path, mode='a' if rows_out else 'w', header=not rows_out, index=False)
+            record['rows_out'] = len(facts)
+        rows_out += len(facts)
+    if workbook is not None:
+        with stage(run, 'export_excel'):
+            workbook.save(excel_out)
+
+    seconds = time.perf_counter() - start
+    return {
+        'rows_in': rows_in,
+        'rows_out': rows_out,
+        'seconds': seconds,
+        'rows_per_sec': rows_in / seconds if seconds else float('nan'),
+        'peak_rss_mb': run_peak_rss_mb(run),
+        'daily_counts': daily_counts.astype('int64').sort_index(),
+        'brand_counts': brand_counts.astype('int64').sort_values(ascending=False),
+        'pack_size_counts': pack_size_counts.astype('int64').sort_index(),
+        'stages': run['stages']
+    }
+
+
+def describe_counts(counts):
+    # describe() of the values behind a value_counts series, without expanding them
+    counts = counts.sort_index()
+    values = counts.index.to_numpy(dtype=float)
+    weights = counts.to_numpy(dtype=float)
+    total = weights.sum()
+    mean = (values * weights).sum() / total
+    std = np.sqrt((weights * (values - mean) ** 2).sum() / (total - 1))
+    cumulative = np.cumsum(weights)
+    quantiles = []
+    # Same linear interpolation as describe(), looking the neighbouring ranks up in the cumulative counts
+    for q in (0.25, 0.5, 0.75):
+        position = q * (total - 1)
+        lower = values[np.searchsorted(cumulative, np.floor(position), side='right')]
+        upper = values[np.searchsorted(cumulative, np.ceil(position), side='right')]
+        quantiles.append(lower + (upper - lower) * (position - np.floor(position)))
+    return pd.Series([total, mean, std, values.min(), *quantiles, values.max()],
+                     index=['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max'], name='pack_size')
+
+
+def print_report(report):
+    peak = report['peak_rss_mb']
+    print(f"Cleansed {report['rows_in']} transactions into {report['rows_out']} customer transactions "
+          f"in {report['seconds']:.1f}s ({report['rows_per_sec']:.0f} rows/sec, "
+          f"peak RSS {'n/a' if peak is None else f'{peak:.0f} MB'})")
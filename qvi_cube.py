@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from qvi_cache import CACHE_DIR, cached_table, load_merged, merged_sources, sales_cents
+
+
+# Segment cube for the summaries: every measure the reports need, summed per
+# (lifestage, premium_customer, brand, month) cell in a single pass over factorized keys.
+# Report tables and charts are roll-ups of the cube, which is a few thousand rows, instead of
+# fresh groupbys over every transaction. The cube is cached next to the merged data and rebuilt
+# when that goes stale.
+
+CUBE_KEYS = ['lifestage', 'premium_customer', 'product_name', 'month']
+CUBE_MEASURES = [
+    'count', 'product_quantity', 'total_sales', 'pack_size', 'pack_size_count',
+    'product_quantity_sq', 'total_sales_sq', 'pack_size_sq'
+]
+CUBE_SCHEMA = 1
+
+
+def factorize_key(column):
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), column.cat.categories
+    return pd.factorize(column, sort=True)
+
+
+def build_cube(frame):
+    months = frame['date'].dt.year * 100 + frame['date'].dt.month
+    keys = [factorize_key(frame[key]) for key in CUBE_KEYS[:-1]] + [factorize_key(months)]
+    shape = tuple(len(categories) for codes, categories in keys)
+    cell = np.ravel_multi_index([codes for codes, categories in keys], shape)
+    size = int(np.prod(shape))
+
+    quantity = frame['product_quantity'].to_numpy(dtype=float)
+    sales = sales_cents(frame['total_sales']) / 100
+    pack_size = frame['pack_size'].to_numpy(dtype=float)
+    has_pack_size = ~np.isnan(pack_size)
+    pack_size = pack_size[has_pack_size]
+    # Sums of squares go with the sums so segment variances can be rolled up too
+    measures = {
+        'count': np.bincount(cell, minlength=size),
+        'product_quantity': np.bincount(cell, weights=quantity, minlength=size),
+        'total_sales': np.bincount(cell, weights=sales, minlength=size),
+        'pack_size': np.bincount(cell[has_pack_size], weights=pack_size, minlength=size),
+        'pack_size_count': np.bincount(cell[has_pack_size], minlength=size),
+        'product_quantity_sq': np.bincount(cell, weights=quantity * quantity, minlength=size),
+        'total_sales_sq': np.bincount(cell, weights=sales * sales, minlength=size),
+        'pack_size_sq': np.bincount(cell[has_pack_size], weights=pack_size * pack_size, minlength=size)
+    }
+    occupied = np.flatnonzero(measures['count'])
+    cube = {}
+    for key, (codes, categories), cell_codes in zip(CUBE_KEYS, keys, np.unravel_index(occupied, shape)):
+        categories = pd.Index(categories).astype(str)
+        cube[key] = pd.Categorical.from_codes(cell_codes, categories)
+    for measure, values in measures.items():
+        cube[measure] = values[occupied]
+    return pd.DataFrame(cube)
+
+
+def segment_cube(cache_dir=CACHE_DIR):
+    cache_path = os.path.join(cache_dir, "segment_cube")
+    columns = CUBE_KEYS[:-1] + ['date', 'product_quantity', 'total_sales', 'pack_size']
+    return cached_table(cache_path, merged_sources(), lambda: build_cube(load_merged(columns=columns)), CUBE_SCHEMA, mmap=False)
+
+
+def rollup(cube, keys):
+    return cube.groupby(keys, observed=True)[CUBE_MEASURES].sum().reset_index()
+
+
+def monthly_totals(cube, keys):
+    # Total sales per keys and month; every transaction's sales were whole cents, so the sums are rounded back to cents
+    rolled = rollup(cube, keys + ['month'])
+    return rolled[keys + ['month']].astype(str).assign(total_sales=np.rint(rolled['total_sales'].to_numpy() * 100) / 100)
+
+
+def segment_mean(cube, keys, measure):
+    rolled = rollup(cube, keys)
+    count = rolled['pack_size_count'] if measure == 'pack_size' else rolled['count']
+    return rolled[keys].assign(**{measure: rolled[measure] / count})
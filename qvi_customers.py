@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from qvi_cache import CACHE_DIR, cached_table, narrow_integers, source_fingerprint
+
+
+# Customer dimension keyed by loyalty card number.
+# The customer table is held once, sorted by card number, and transactions look their customer up by
+# binary search on the card column instead of carrying lifestage and premium_customer on every row.
+# Any batch of transactions can be joined to its customer attributes on demand, so the cleansing no
+# longer has to write out a denormalised merged file for every later script to parse again.
+
+new_QVI_purchase_names = {
+    "LYLTY_CARD_NBR": "loyalty_card_number",
+    "LIFESTAGE": "lifestage",
+    "PREMIUM_CUSTOMER": "premium_customer"
+}
+
+CUSTOMER_DTYPES = {'LYLTY_CARD_NBR': 'int64', 'LIFESTAGE': 'category', 'PREMIUM_CUSTOMER': 'category'}
+CUSTOMER_COLUMNS = ['lifestage', 'premium_customer']
+CUSTOMERS_SCHEMA = 1
+
+
+def read_customers(path="QVI_purchase_behaviour.csv"):
+    return narrow_integers(pd.read_csv(path, dtype=CUSTOMER_DTYPES)).rename(columns=new_QVI_purchase_names)
+
+
+def customer_dimension(customers):
+    # One row per card, sorted so lookups can binary search the card column
+    dimension = customers.drop_duplicates('loyalty_card_number', keep='last')
+    return dimension.sort_values('loyalty_card_number', kind='stable').reset_index(drop=True)
+
+
+def load_customer_dimension(path="QVI_purchase_behaviour.csv", cache_dir=CACHE_DIR):
+    cache_path = os.path.join(cache_dir, "customers")
+    return cached_table(cache_path, source_fingerprint([path]), lambda: customer_dimension(read_customers(path)), CUSTOMERS_SCHEMA, mmap=False)
+
+
+def customer_positions(dimension, cards):
+    # Row of each card in the dimension, and whether the card was found at all
+    keys = dimension['loyalty_card_number'].to_numpy()
+    cards = np.asarray(cards)
+    positions = np.searchsorted(keys, cards)
+    positions[positions == len(keys)] = 0
+    found = keys[positions] == cards if len(keys) else np.zeros(len(cards), dtype=bool)
+    return positions, found
+
+
+def join_customers(frame, dimension, columns=CUSTOMER_COLUMNS):
+    # Inner join of a transaction batch to its customers' attributes, keeping the batch's row order
+    positions, found = customer_positions(dimension, frame['loyalty_card_number'])
+    if not found.all():
+        frame, positions = frame[found], positions[found]
+    attributes = {}
+    for column in columns:
+        values = dimension[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            attributes[column] = pd.Categorical.from_codes(values.cat.codes.to_numpy()[positions], values.cat.categories)
+        else:
+            attributes[column] = values.to_numpy()[positions]
+    return frame.assign(**attributes)
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+
+
+# HyperLogLog distinct customer counts.
+# A sketch is a row of 2**precision one-byte registers. Each loyalty card number is hashed, the top
+# `precision` bits pick a register and the register keeps the longest run of leading zeros seen in
+# the rest of the hash. Sketches merge with an elementwise max, so per (store, month) sketches can be
+# rolled up to stores, regions or the whole chain without going back to the transactions. The
+# relative standard error is about 1.04 / sqrt(2**precision); precision_for_error picks the
+# precision for a target error and validate_sketches checks the estimates against exact counts.
+# Registers are folded in SKETCH_CHUNK_ROWS rows at a time and estimated ESTIMATE_BLOCK_REGISTERS
+# registers at a time through a table of 2**-rank, so beyond the registers themselves memory stays
+# a few MB however many rows or sketches there are.
+
+DEFAULT_ERROR = 0.02
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+SKETCH_CHUNK_ROWS = 65_536
+ESTIMATE_BLOCK_REGISTERS = 2**18
+# 2**-rank for every rank a register can hold, 64 - MIN_PRECISION + 1 at most
+RANK_POWERS = 2.0 ** -np.arange(65)
+
+
+def precision_for_error(relative_error=DEFAULT_ERROR):
+    precision = int(np.ceil(np.log2((1.04 / relative_error) ** 2)))
+    return min(max(precision, MIN_PRECISION), MAX_PRECISION)
+
+
+def standard_error(precision):
+    return 1.04 / np.sqrt(2 ** precision)
+
+
+def hash64(values):
+    # splitmix64 finaliser, uint64 arithmetic wraps around as the hash needs
+    z = np.asarray(values).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def bit_length(values):
+    values = values.copy()
+    length = np.zeros(len(values), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        wide = values >= (np.uint64(1) << np.uint64(shift))
+        length += np.uint8(shift) * wide
+        values[wide] >>= np.uint64(shift)
+    return length + (values > 0)
+
+
+def register_updates(values, precision):
+    # Register index and rank (leading zeros + 1 in the remaining bits) of every value
+    hashes = hash64(values)
+    rest_bits = 64 - precision
+    index = (hashes >> np.uint64(rest_bits)).astype(np.int64)
+    rest = hashes & np.uint64((1 << rest_bits) - 1)
+    rank = (rest_bits + 1 - bit_length(rest)).astype(np.uint8)
+    return index, rank
+
+
+def grouped_sketches(groups, values, n_groups, precision, chunksize=SKETCH_CHUNK_ROWS):
+    # One sketch per group code in 0..n_groups-1, each chunk of rows folded into the registers in place
+    registers = np.zeros((n_groups, 1 << precision), dtype=np.uint8)
+    cells = registers.reshape(-1)
+    groups, values = np.asarray(groups), np.asarray(values)
+    for start in range(0, len(values), chunksize):
+        index, rank = register_updates(values[start:start + chunksize], precision)
+        cell = groups[start:start + chunksize].astype(np.int64) * (1 << precision) + index
+        np.maximum.at(cells, cell, rank)
+    return registers
+
+
+def estimate(registers):
+    # Distinct count estimate per sketch row, linear counting while registers are still empty
+    registers = np.atleast_2d(registers)
+    n, m = registers.shape
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+    harmonic = np.empty(n)
+    zeros = np.empty(n, dtype=np.int64)
+    block = max(1, ESTIMATE_BLOCK_REGISTERS // m)
+    for start in range(0, n, block):
+        rows = registers[start:start + block]
+        harmonic[start:start + block] = RANK_POWERS[rows].sum(axis=1)
+        zeros[start:start + block] = np.count_nonzero(rows == 0, axis=1)
+    raw = alpha * m * m / harmonic
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+def merge_sketches(registers, labels):
+    # Merge sketch rows that share a label, returns the labels and one merged row per label
+    codes, uniques = pd.factorize(np.asarray(labels), sort=True)
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.r_[True, codes[order][1:] != codes[order][:-1]])
+    return uniques, np.maximum.reduceat(registers[order], starts, axis=0)
+
+
+def distinct_customers(registers, labels):
+    # Estimated customers per label, e.g. labels of store -> region for every (store, month) sketch row
+    labels, merged = merge_sketches(registers, labels)
+    return pd.Series(estimate(merged), index=labels, name='total_cust')
+
+
+def store_month_sketches(data, precision=None):
+    # Sketches of the customers of each (store, month) in data, which needs a month column
+    precision = precision or precision_for_error()
+    groups = data.groupby(['store_number', 'month'], observed=True)
+    keys = groups.size().index.to_frame(index=False)
+    registers = grouped_sketches(groups.ngroup().to_numpy(), data['loyalty_card_number'].to_numpy(), len(keys), precision)
+    return keys, registers
+
+
+def validate_sketches(data, keys, registers):
+    # Estimated against exact distinct customers per store and month, per store, per month over the
+    # chain and for the whole chain, rolling the (store, month) sketches up with merge_sketches;
+    # within_2se is the share inside two standard errors, about 95% expected
+    precision = int(np.log2(registers.shape[1]))
+    levels = {
+        'store_month': (keys['store_number'].astype(str) + '/' + keys['month'].astype(str), ['store_number', 'month']),
+        'store': (keys['store_number'], ['store_number']),
+        'month': (keys['month'], ['month']),
+        'chain': (np.zeros(len(keys), dtype=int), [])
+    }
+    rows = []
+    for level, (labels, columns) in levels.items():
+        labels, merged = merge_sketches(registers, labels)
+        estimated = estimate(merged)
+        if columns:
+            exact = data.groupby(columns, observed=True)['loyalty_card_number'].nunique()
+            if len(columns) > 1:
+                exact.index = exact.index.map(lambda key: '/'.join(map(str, key)))
+            exact = exact.reindex(labels).to_numpy(dtype=float)
+        else:
+            exact = np.array([data['loyalty_card_number'].nunique()], dtype=float)
+        error = (estimated - exact) / exact
+        rows.append({
+            'level': level,
+            'groups': len(exact),
+            'mean_abs_error': np.abs(error).mean(),
+            'max_abs_error': np.abs(error).max(),
+            'within_2se': np.mean(np.abs(error) <= 2 * standard_error(precision))
+        })
+    return pd.DataFrame(rows).assign(precision=precision, standard_error=standard_error(precision))
+
+
+if __name__ == '__main__':
+    # python qvi_hll.py [relative_error] checks the memoized store metrics' sketches against exact counts on the merged data
+    import sys
+    from qvi_cache import load_merged
+    from qvi_trials import store_metrics
+    sketches = store_metrics(distinct='hll', relative_error=float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ERROR)['sketches']
+    sheet = load_merged(columns=['date', 'store_number', 'loyalty_card_number'])
+    sheet['month'] = sheet['date'].dt.strftime('%Y%m')
+    print(validate_sketches(sheet, sketches['keys'], sketches['registers']).to_string())
@@ -0,0 +1,51 @@
+# Chart functions shared by the analysis scripts.
+# Each one draws a single chart from an already aggregated frame and returns its figure, so the
+# charts can be shown interactively or handed to qvi_render to be written out in worker processes.
+# matplotlib and seaborn are only imported once a chart is actually drawn.
+
+
+def line_chart(data, x, y, title, xlabel, ylabel, hue=None, legend_title=None, legend_outside=False,
+               figsize=(12, 8), xtick_rotation=None, tight=True):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    fig = plt.figure(figsize=figsize)
+    sns.lineplot(data=data, x=x, y=y, hue=hue, marker='o')
+    plt.title(title)
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    if xtick_rotation is not None:
+        plt.xticks(rotation=xtick_rotation)
+    if legend_title is not None:
+        if legend_outside:
+            plt.legend(title=legend_title, bbox_to_anchor=(1.05, 1), loc='upper left')
+        else:
+            plt.legend(title=legend_title)
+    if tight:
+        plt.tight_layout()
+    return fig
+
+
+def segment_bar_chart(data, y, ylabel, title):
+    # Lifestage on the x axis, one bar per premium_customer type
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    fig = plt.figure(figsize=(12, 8))
+    sns.barplot(data=data, x='lifestage', y=y, hue='premium_customer', errorbar=None, palette='muted')
+    plt.xlabel('Lifestage')
+    plt.ylabel(ylabel)
+    plt.title(title)
+    plt.legend(title='Customer Type', bbox_to_anchor=(1.05, 1), loc='upper left')
+    plt.tight_layout()
+    return fig
+
+
+def brand_sales_chart(data):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    grid = sns.catplot(data=data, x='product_name', y='total_sales', hue='lifestage', kind="bar", height=8, aspect=1.5)
+    plt.title('Total Sales of Chip Product per Customer Category')
+    plt.xlabel('Product Name')
+    plt.ylabel('Total Sales')
+    plt.xticks(rotation=90)
+    plt.tight_layout()
+    return grid.figure
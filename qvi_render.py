@@ -0,0 +1,76 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+
+# Chart rendering for the analysis scripts.
+# A chart is a (name, function, kwargs) tuple, where function is one of the qvi_plots chart
+# functions. By default every chart is shown interactively as before. Setting QVI_PLOT_DIR turns
+# on batch mode: charts are drawn on the Agg backend, written to QVI_PLOT_DIR in every format in
+# QVI_PLOT_FORMATS (png, pdf, svg, comma separated) and closed straight away, optionally across
+# QVI_PLOT_WORKERS processes. Batch mode prints how long each chart took to render.
+# matplotlib is only imported when charts are rendered.
+
+PLOT_DIR = os.environ.get('QVI_PLOT_DIR')
+PLOT_FORMATS = os.environ.get('QVI_PLOT_FORMATS', 'png').split(',')
+PLOT_WORKERS = int(os.environ.get('QVI_PLOT_WORKERS', '1'))
+
+
+def _use_agg():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def draw(chart):
+    name, function, kwargs = chart
+    return function(**kwargs)
+
+
+def render_to_files(chart, plot_dir, formats, pdf=None):
+    import matplotlib.pyplot as plt
+    start = time.perf_counter()
+    fig = draw(chart)
+    for fmt in formats:
+        fig.savefig(os.path.join(plot_dir, f"{chart[0]}.{fmt}"), format=fmt)
+    if pdf is not None:
+        pdf.savefig(fig)
+    plt.close(fig)
+    return {'chart': chart[0], 'seconds': time.perf_counter() - start}
+
+
+def show(charts, pdf=None):
+    import matplotlib.pyplot as plt
+    for chart in charts:
+        fig = draw(chart)
+        if pdf is not None:
+            pdf.savefig(fig)
+        plt.show()
+
+
+def render_charts(charts, pdf_path=None, plot_dir=PLOT_DIR, formats=PLOT_FORMATS, workers=PLOT_WORKERS):
+    # pdf_path additionally collects every chart, one per page, into a single PDF
+    if plot_dir:
+        _use_agg()
+    from matplotlib.backends.backend_pdf import PdfPages
+    pdf = PdfPages(pdf_path) if pdf_path else None
+    try:
+        if not plot_dir:
+            show(charts, pdf)
+            return []
+        os.makedirs(plot_dir, exist_ok=True)
+        if pdf is not None or workers <= 1:
+            timings = [render_to_files(chart, plot_dir, formats, pdf) for chart in charts]
+        else:
+            with ProcessPoolExecutor(workers, initializer=_use_agg) as pool:
+                timings = list(pool.map(render_to_files, charts, repeat(plot_dir), repeat(formats)))
+    finally:
+        if pdf is not None:
+            pdf.close()
+    print_timings(timings)
+    return timings
+
+
+def print_timings(timings):
+    for timing in timings:
+        print(f"Rendered {timing['chart']} in {timing['seconds']:.2f}s")
@@ -0,0 +1,123 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+# Bootstrap and permutation tests for trial uplift and segment differences.
+# Resamples are drawn a batch at a time as index / sign / shuffle arrays and reduced with one
+# vectorized mean per batch. Batch sizes keep each drawn array under BATCH_CELLS values, so large
+# segments don't need the whole resample matrix in memory. Every batch gets its own child of one
+# SeedSequence, so the statistics are the same whether the batches run here or across a process pool.
+# Large groups with few distinct values, like quantities or prices, are resampled as counts of each
+# value instead: multinomial draws for the bootstrap and multivariate hypergeometric draws for the
+# permutations give the same distributions at a cost per resample that no longer grows with the group.
+
+SEED = 2018
+RESAMPLES = 10_000
+CONFIDENCE = 0.95
+BATCH_CELLS = 2**22
+# Resample by value counts when the group has at least this many rows per distinct value
+COUNT_RATIO = 8
+
+
+def batch_sizes(resamples, n):
+    batch = max(1, min(resamples, BATCH_CELLS // max(n, 1)))
+    return [min(batch, resamples - start) for start in range(0, resamples, batch)]
+
+
+def value_counts(values):
+    uniques, counts = np.unique(values, return_counts=True)
+    return uniques, counts, len(uniques) * COUNT_RATIO <= len(values)
+
+
+def bootstrap_means(rng, values, size):
+    uniques, counts, by_count = value_counts(values)
+    if by_count:
+        return rng.multinomial(len(values), counts / len(values), size=size) @ uniques / len(values)
+    return values[rng.integers(0, len(values), size=(size, len(values)))].mean(axis=1)
+
+
+def resample_batch(kind, seed, size, first, second):
+    rng = np.random.default_rng(seed)
+    if kind == 'paired_bootstrap':
+        # Mean of the trial - control differences over resampled months
+        diffs = first - second
+        return diffs[rng.integers(0, len(diffs), size=(size, len(diffs)))].mean(axis=1)
+    if kind == 'paired_permutation':
+        # Under no effect each month's difference is as likely to have either sign
+        diffs = first - second
+        signs = rng.integers(0, 2, size=(size, len(diffs))) * 2 - 1
+        return (signs * diffs).mean(axis=1)
+    if kind == 'bootstrap':
+        return bootstrap_means(rng, first, size) - bootstrap_means(rng, second, size)
+    if kind == 'permutation':
+        # Shuffle the group labels, only which values land in the first group matters for the means
+        pooled = np.concatenate([first, second])
+        uniques, counts, by_count = value_counts(pooled)
+        if by_count:
+            first_sums = rng.multivariate_hypergeometric(counts, len(first), size=size, method='marginals') @ uniques
+        else:
+            first_sums = rng.permuted(np.tile(pooled, (size, 1)), axis=1)[:, :len(first)].sum(axis=1)
+        return first_sums / len(first) - (pooled.sum() - first_sums) / len(second)
+    raise ValueError(f"Unknown resampling {kind}")
+
+
+def resample(kind, first, second, resamples=RESAMPLES, seed=SEED, workers=1):
+    first = np.asarray(first, dtype=float)
+    second = np.asarray(second, dtype=float)
+    sizes = batch_sizes(resamples, len(first) + len(second))
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers == 1 or len(sizes) == 1:
+        stats = [resample_batch(kind, batch_seed, size, first, second) for batch_seed, size in zip(seeds, sizes)]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            stats = list(pool.map(resample_batch, [kind] * len(sizes), seeds, sizes, [first] * len(sizes), [second] * len(sizes)))
+    return np.concatenate(stats)
+
+
+def permutation_p_value(null_stats, observed):
+    # Two-sided, counting the observed arrangement itself so p is never 0
+    return (np.count_nonzero(np.abs(null_stats) >= abs(observed) - 1e-12) + 1) / (len(null_stats) + 1)
+
+
+def summarise(observed, bootstrap_stats, null_stats, confidence):
+    tail = (1 - confidence) / 2
+    return {
+        'difference': observed,
+        'ci_low': np.quantile(bootstrap_stats, tail),
+        'ci_high': np.quantile(bootstrap_stats, 1 - tail),
+        'p_value': permutation_p_value(null_stats, observed)
+    }
+
+
+def paired_uplift(trial, control, resamples=RESAMPLES, seed=SEED, workers=1, confidence=CONFIDENCE):
+    # Mean trial - control uplift over matched months, with a bootstrap interval and sign-flip p-value
+    trial = np.asarray(trial, dtype=float)
+    control = np.asarray(control, dtype=float)
+    observed = (trial - control).mean()
+    bootstrap_stats = resample('paired_bootstrap', trial, control, resamples, seed, workers)
+    null_stats = resample('paired_permutation', trial, control, resamples, seed + 1, workers)
+    return summarise(observed, bootstrap_stats, null_stats, confidence)
+
+
+def mean_difference(first, second, resamples=RESAMPLES, seed=SEED, workers=1, confidence=CONFIDENCE):
+    # Difference in means between two independent groups, with a bootstrap interval and label permutation p-value
+    first = np.asarray(first, dtype=float)
+    second = np.asarray(second, dtype=float)
+    observed = first.mean() - second.mean()
+    bootstrap_stats = resample('bootstrap', first, second, resamples, seed, workers)
+    null_stats = resample('permutation', first, second, resamples, seed + 1, workers)
+    return summarise(observed, bootstrap_stats, null_stats, confidence)
+
+
+def trial_uplifts(comparison_results, trial_stores, metrics, resamples=RESAMPLES, seed=SEED, workers=1):
+    # paired_uplift for every trial store and metric in a compare_trial_stores table
+    rows = []
+    for store in trial_stores:
+        store_data = comparison_results[comparison_results['store_number'] == store].sort_values(by='month')
+        for metric in metrics:
+            paired = store_data[[f'{metric}_trial', f'{metric}_control']].dropna()
+            result = paired_uplift(paired[f'{metric}_trial'], paired[f'{metric}_control'], resamples, seed, workers)
+            rows.append({'trial_store': store, 'metric': metric, **result})
+    return pd.DataFrame(rows)
@@ -0,0 +1,231 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import pandas as pd
+
+from qvi_cache import CACHE_DIR, CACHE_VERSION, FACTS_PATH, cached_table, merged_sources
+from qvi_stages import new_run, print_stages, stage, write_run_log
+
+
+# Command line trial analysis with cached, resumable stages.
+#
+#   python qvi_run.py --trial-stores 77 86 88 --trial-start 201902 --trial-end 201904 \
+#       --metrics total_sales total_cust avg_trans --out trial_results
+#
+# Every stage result is stored under <out>/stages/<stage>-<digest>, where the digest hashes the stage
+# name, its parameters, the digests of the stages it reads, the cache version and the control scoring
+# and scaling settings. The root digest hashes the size and modification time fingerprint of the data
+# files, as for the .qvi_cache, not their contents. A stage whose digest is already on disk, written
+# under the same cache version and STAGE_SCHEMA, is read back instead of recomputed, so adding a trial
+# store or a metric only computes the new stages, and an interrupted run picks up from the last stage
+# that finished. Stages are written to a temporary directory and swapped in, so a half written stage
+# is never reused.
+#
+# Per trial store the stages are:
+#   controls     every candidate ranked on the pre-trial window of the selection metric, candidates are
+#                all other stores so the ranking doesn't change when trial stores are added
+#   comparison   trial store against its control scaled to the trial store's pre-trial level, per metric,
+#                by the ranking's scaling_factor for the selection metric and the same rule for the others
+#   uplift       mean trial period uplift per metric, with a bootstrap interval and permutation p-value
+# and data wide: store_metrics (the memoized metric table) and segment_state, which monthly_reports
+# writes out as the segment sales CSVs.
+
+DEFAULT_TRIAL_STORES = [77, 86, 88]
+DEFAULT_METRICS = ['total_sales', 'total_cust', 'avg_trans']
+TRIAL_END = '201904'
+OUT_DIR = "trial_results"
+STAGE_SCHEMA = 1
+
+
+def scoring_settings():
+    # Code level settings every stage result depends on without them being stage parameters
+    from qvi_trials import MAGNITUDE_WEIGHT, MIN_PRETRIAL_MONTHS, SCALING_RULE
+    return {'cache_version': CACHE_VERSION, 'magnitude_weight': MAGNITUDE_WEIGHT,
+            'min_pretrial_months': MIN_PRETRIAL_MONTHS, 'scaling_rule': SCALING_RULE}
+
+
+def digest(name, inputs, params):
+    key = json.dumps({'stage': name, 'inputs': inputs, 'params': params, 'settings': scoring_settings()}, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def cached_stage(run, out_dir, name, inputs, params, compute):
+    # Returns (digest, frame), computing the frame only when no stage with this digest is stored
+    stage_digest = digest(name, inputs, params)
+    path = os.path.join(out_dir, "stages", f"{name}-{stage_digest}")
+    computed = []
+
+    def build():
+        frame = compute()
+        computed.append(True)
+        text = [column for column in frame.columns if pd.api.types.is_string_dtype(frame[column].dtype)]
+        return frame.astype({column: 'category' for column in text})
+    with stage(run, name) as record:
+        frame = cached_table(path, {'digest': stage_digest, 'params': params}, build, STAGE_SCHEMA, mmap=False)
+        # Text columns are stored as categoricals, hand them back as the strings they were
+        frame = frame.astype({column: str for column in frame.columns if isinstance(frame[column].dtype, pd.CategoricalDtype)})
+        record['rows_out'] = len(frame)
+    run.setdefault('cache_hits', {}).setdefault(name, []).append(not computed)
+    return stage_digest, frame
+
+
+def trial_months(months, trial_start, trial_end):
+    return [month for month in months if trial_start <= month <= trial_end]
+
+
+def rank_controls(metric_store, trial_store, metric, trial_start, window):
+    # Every other store ranked, on the pre-trial stats the metric store keeps per (metric, trial_start, window)
+    from qvi_trials import metric_pretrial_stats, select_pretrial_controls
+    stats = metric_pretrial_stats(metric_store, metric, trial_start, window)
+    potential_control = [store for store in metric_store['slices'] if store != trial_store]
+    return select_pretrial_controls(metric_store['metrics'], [trial_store], potential_control, metric, trial_start, window,
+                                    top_k=len(potential_control), stats=stats)[trial_store]
+
+
+def compare_to_control(metric_store, trial_store, control_store, metric, scaling_factor, trial_start, trial_end, window):
+    # Monthly trial and scaled control values of one metric, over the months both stores traded
+    from qvi_trials import lookup_metrics, metric_pretrial_stats, scale_control_metrics
+    trial = lookup_metrics(metric_store, trial_store).set_index('month')
+    control = scale_control_metrics(lookup_metrics(metric_store, control_store), {metric: scaling_factor}).set_index('month')
+    months = sorted(set(trial.index) & set(control.index))
+    pretrial = set(metric_pretrial_stats(metric_store, metric, trial_start, window)['months'])
+    during = set(trial_months(months, trial_start, trial_end))
+    comparison = pd.DataFrame({
+        'metric': metric,
+        'month': months,
+        'period': ['trial' if month in during else 'pre_trial' if month in pretrial else 'other' for month in months],
+        'trial': trial.loc[months, metric].to_numpy(dtype=float),
+        'control_scaled': control.loc[months, metric].to_numpy(dtype=float),
+        'scaling_factor': scaling_factor
+    })
+    comparison['pct_diff'] = (comparison['trial'] - comparison['control_scaled']) / comparison['control_scaled']
+    return comparison
+
+
+def trial_uplift(comparison, resamples, seed):
+    from qvi_resample import paired_uplift
+    rows = []
+    for metric, rows_of_metric in comparison.groupby('metric', sort=False):
+        during = rows_of_metric[rows_of_metric['period'] == 'trial']
+        pretrial = rows_of_metric[rows_of_metric['period'] == 'pre_trial']
+        result = paired_uplift(during['trial'], during['control_scaled'], resamples, seed) if len(during) else {}
+        rows.append({
+            'metric': metric,
+            'trial_months': len(during),
+            # How unusual the trial months' gap is next to the pre-trial months' month to month spread
+            'pretrial_pct_std': pretrial['pct_diff'].std(),
+            'trial_pct_diff': during['pct_diff'].mean(),
+            **result
+        })
+    return pd.DataFrame(rows)
+
+
+def run_trial_analysis(trial_stores, metrics, out_dir=OUT_DIR, selection_metric='total_sales', trial_start=None,
+                       trial_end=TRIAL_END, window=None, resamples=None, seed=None, path=FACTS_PATH,
+                       cache_dir=CACHE_DIR, reports=True):
+    from qvi_resample import RESAMPLES, SEED
+    from qvi_trials import TRIAL_START, pretrial_scaling_factors, store_metrics
+    trial_start = trial_start or TRIAL_START
+    resamples = resamples or RESAMPLES
+    seed = SEED if seed is None else seed
+    os.makedirs(out_dir, exist_ok=True)
+    run = new_run('trials', profile_dir=os.environ.get('QVI_PROFILE_DIR'))
+
+    # Root of the stage digests: the data files' size and modification time fingerprint, not a hash of their contents
+    data_digest = digest('data', [], merged_sources(path))
+    with stage(run, 'store_metrics'):
+        metric_store = store_metrics(path, cache_dir)
+
+    if reports:
+        from qvi_aggregates import segment_month_state, write_monthly_reports
+        from qvi_cache import load_merged
+        columns = ['lifestage', 'premium_customer', 'date', 'total_sales']
+        state = cached_stage(run, out_dir, 'segment_state', [data_digest], {},
+                             lambda: segment_month_state(load_merged(columns=columns, path=path, cache_dir=cache_dir)))[1]
+        with stage(run, 'monthly_reports'):
+            write_monthly_reports(state, out_dir)
+
+    controls, comparisons, uplifts = [], [], []
+    for trial_store in trial_stores:
+        control_params = {'trial_store': trial_store, 'metric': selection_metric, 'trial_start': trial_start, 'window': window}
+        control_digest, ranking = cached_stage(run, out_dir, 'controls', [data_digest], control_params,
+                                               lambda: rank_controls(metric_store, trial_store, selection_metric, trial_start, window))
+        # Other trial stores can't be controls, that is filtered here so the ranking above stays reusable
+        ranking = ranking[~ranking['control_store'].isin(trial_stores)]
+        if ranking.empty:
+            print(f"No control store found for trial store {trial_store}")
+            continue
+        control_store = int(ranking['control_store'].iloc[0])
+        controls.append(ranking.head(1).assign(trial_store=trial_store))
+
+        # One comparison and uplift stage per metric, so adding a metric leaves the others cached
+        for metric in metrics:
+            comparison_params = {'trial_store': trial_store, 'control_store': control_store, 'metric': metric,
+                                 'trial_start': trial_start, 'trial_end': trial_end, 'window': window}
+
+            def compare():
+                # The ranking's own factor for the selection metric, the same pre-trial rule for the others
+                if metric == selection_metric:
+                    factor = ranking['scaling_factor'].iloc[0]
+                else:
+                    factor = pretrial_scaling_factors(metric_store, trial_store, control_store, [metric], trial_start, window)[metric]
+                return compare_to_control(metric_store, trial_store, control_store, metric, factor, trial_start, trial_end, window)
+            comparison_digest, comparison = cached_stage(run, out_dir, 'comparison', [data_digest], comparison_params, compare)
+            uplift_digest, uplift = cached_stage(run, out_dir, 'uplift', [comparison_digest], {'resamples': resamples, 'seed': seed},
+                                                 lambda: trial_uplift(comparison, resamples, seed))
+            comparisons.append(comparison.assign(trial_store=trial_store, control_store=control_store))
+            uplifts.append(uplift.assign(trial_store=trial_store, control_store=control_store))
+
+    outputs = {'controls': controls, 'comparison': comparisons, 'uplift': uplifts}
+    for name, frames in outputs.items():
+        table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        first = [column for column in ('trial_store', 'control_store') if column in table.columns]
+        table = table[first + [column for column in table.columns if column not in first]]
+        table.to_csv(os.path.join(out_dir, f"{name}.csv"), index=False)
+        outputs[name] = table
+    write_run_log(run, os.path.join(out_dir, "run_log.jsonl"))
+    return outputs, run
+
+
+def window_months(value):
+    window = int(value)
+    if window < 1:
+        raise argparse.ArgumentTypeError(f"the pre-trial window needs at least 1 month, got {value}")
+    return window
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Select control stores and measure trial uplift, reusing cached stages")
+    parser.add_argument('--trial-stores', type=int, nargs='+', default=DEFAULT_TRIAL_STORES)
+    parser.add_argument('--metrics', nargs='+', default=DEFAULT_METRICS, choices=DEFAULT_METRICS)
+    parser.add_argument('--selection-metric', default='total_sales', choices=DEFAULT_METRICS)
+    parser.add_argument('--trial-start', help="first trial month, YYYYMM (default 201902)")
+    parser.add_argument('--trial-end', default=TRIAL_END, help="last trial month, YYYYMM")
+    parser.add_argument('--window', type=window_months, help="pre-trial months to calibrate on, default all of them")
+    parser.add_argument('--resamples', type=int)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--out', default=OUT_DIR)
+    parser.add_argument('--data', default=FACTS_PATH, help="transaction facts CSV")
+    parser.add_argument('--no-reports', action='store_true', help="skip the monthly segment sales CSVs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    outputs, run = run_trial_analysis(
+        args.trial_stores, args.metrics, args.out, args.selection_metric, args.trial_start, args.trial_end,
+        args.window, args.resamples, args.seed, args.data, reports=not args.no_reports)
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        print(outputs['controls'])
+        print(outputs['uplift'])
+    print_stages(run)
+    hits = {name: f"{sum(cached)}/{len(cached)}" for name, cached in run.get('cache_hits', {}).items()}
+    print(f"Stages reused from {os.path.join(args.out, 'stages')}: {hits}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
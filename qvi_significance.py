@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from qvi_cache import CACHE_DIR, cached_table, merged_sources
+from qvi_cube import rollup, segment_cube
+
+
+# Welch t-tests between every pair of (lifestage, premium_customer) segments.
+# Each segment's count, mean and variance come from the sums and sums of squares in the segment
+# cube, so all pairs for every measure are tested together from a few dozen aggregate rows instead
+# of masking the transactions once per segment. p-values are corrected for the number of tests run.
+# The table is cached next to the cube and is rebuilt when the data changes.
+
+SEGMENT_KEYS = ['lifestage', 'premium_customer']
+SIGNIFICANCE_MEASURES = ['product_quantity', 'total_sales', 'pack_size']
+ALPHA = 0.05
+SIGNIFICANCE_SCHEMA = 1
+
+
+def segment_moments(cube, measure, keys=SEGMENT_KEYS):
+    rolled = rollup(cube, keys)
+    count = rolled['pack_size_count' if measure == 'pack_size' else 'count'].to_numpy(dtype=float)
+    total = rolled[measure].to_numpy(dtype=float)
+    squares = rolled[measure + '_sq'].to_numpy(dtype=float)
+    mean = total / count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = np.maximum(squares - total * mean, 0) / (count - 1)
+    segment = rolled[keys[0]].astype(str)
+    for key in keys[1:]:
+        segment = segment + ' - ' + rolled[key].astype(str)
+    return pd.DataFrame({'segment': segment, 'count': count, 'mean': mean, 'variance': variance})
+
+
+def welch_pairs(moments):
+    # Welch t statistic and Welch-Satterthwaite degrees of freedom for every pair i < j
+    from scipy.stats import t as t_dist
+    first, second = np.triu_indices(len(moments), k=1)
+    count, mean, variance = (moments[column].to_numpy() for column in ('count', 'mean', 'variance'))
+    standard_error = variance / count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_stat = (mean[first] - mean[second]) / np.sqrt(standard_error[first] + standard_error[second])
+        df = (standard_error[first] + standard_error[second]) ** 2 / (
+            standard_error[first] ** 2 / (count[first] - 1) + standard_error[second] ** 2 / (count[second] - 1))
+    return pd.DataFrame({
+        'first': moments['segment'].to_numpy()[first],
+        'second': moments['segment'].to_numpy()[second],
+        'mean_diff': mean[first] - mean[second],
+        't_stat': t_stat,
+        'df': df,
+        'p_value': 2 * t_dist.sf(np.abs(t_stat), df)
+    })
+
+
+def adjust_p_values(p_values, method='fdr_bh'):
+    # Benjamini-Hochberg false discovery rate, or Holm's family-wise step-down
+    p_values = np.asarray(p_values, dtype=float)
+    n = len(p_values)
+    order = np.argsort(p_values, kind='stable')
+    ranked = p_values[order]
+    if method == 'fdr_bh':
+        adjusted = np.minimum.accumulate((ranked * n / np.arange(1, n + 1))[::-1])[::-1]
+    elif method == 'holm':
+        adjusted = np.maximum.accumulate(ranked * (n - np.arange(n)))
+    else:
+        raise ValueError(f"Unknown correction {method}")
+    result = np.empty(n)
+    result[order] = np.minimum(adjusted, 1)
+    return result
+
+
+def significance_table(cube, measures=SIGNIFICANCE_MEASURES, method='fdr_bh', alpha=ALPHA):
+    tables = [welch_pairs(segment_moments(cube, measure)).assign(measure=measure) for measure in measures]
+    table = pd.concat(tables, ignore_index=True)
+    # Corrected over every pair of every measure, they are all read as one set of findings
+    table['p_adjusted'] = adjust_p_values(table['p_value'].fillna(1), method)
+    table['significant'] = table['p_adjusted'] < alpha
+    table = table.astype({'measure': 'category', 'first': 'category', 'second': 'category'})
+    return table[['measure', 'first', 'second', 'mean_diff', 't_stat', 'df', 'p_value', 'p_adjusted', 'significant']]
+
+
+def segment_significance(cache_dir=CACHE_DIR, method='fdr_bh'):
+    cache_path = os.path.join(cache_dir, "segment_significance_" + method)
+    return cached_table(cache_path, merged_sources(), lambda: significance_table(segment_cube(cache_dir), method=method),
+                        SIGNIFICANCE_SCHEMA, mmap=False)
+
+
+def significance_matrix(table, measure, value='p_adjusted'):
+    # Square segment x segment view of one measure, symmetric with an empty diagonal
+    rows = table[table['measure'] == measure]
+    upper = rows.pivot(index='first', columns='second', values=value)
+    segments = sorted(set(rows['first']) | set(rows['second']))
+    upper = upper.reindex(index=segments, columns=segments)
+    return upper.combine_first(upper.T)
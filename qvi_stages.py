@@ -0,0 +1,171 @@
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+# Named, instrumented pipeline stages.
+# Wrapping a step in `with stage(run, 'name') as record:` records its wall time, CPU time, peak
+# memory and the bytes the process read and wrote while it ran; the step fills in rows_in / rows_out
+# on the record. A stage entered many times, like the per-chunk cleansing steps, is summed into one
+# entry. write_run_log appends one JSON line per stage to the run log, and when QVI_PROFILE_DIR is set
+# every stage is also captured with cProfile into <run_id>.<stage>.prof there, which snakeviz or
+# flameprof can turn into a flame graph.
+#
+# Peak memory is per stage when the run asks for it with stage_memory=True on Linux, where the
+# process high-water mark can be reset at each stage start; otherwise a stage's peak is the peak of
+# the whole process so far. The reset also clears what getrusage reports, so the peak of the whole
+# run is kept on the run itself and read with run_peak_rss_mb, never with peak_rss_mb. Bytes come from
+# /proc/self/io and count everything the process read or wrote through system calls, pages read
+# from memory-mapped caches are not included. Both are None where they can't be measured.
+
+RUN_LOG_PATH = os.environ.get('QVI_RUN_LOG', "qvi_run_log.jsonl")
+PROFILE_DIR = os.environ.get('QVI_PROFILE_DIR')
+STAGE_FIELDS = ['calls', 'wall_s', 'cpu_s', 'peak_rss_mb', 'rows_in', 'rows_out', 'bytes_read', 'bytes_written']
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def io_counters():
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(':') for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def stage_peak_rss_mb():
+    # High-water mark since the last reset_peak_rss
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def new_run(name, profile_dir=PROFILE_DIR, stage_memory=False):
+    return {
+        'run_id': f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}",
+        'name': name,
+        'started': time.time(),
+        'stages': {},
+        'active': [],
+        'profiles': {},
+        'profiling': False,
+        'profile_dir': profile_dir,
+        'stage_memory': stage_memory,
+        # Peak before the first reset, every stage's peak is folded in as it ends
+        'peak_rss_mb': stage_peak_rss_mb()
+    }
+
+
+def run_peak_rss_mb(run):
+    # Peak of the whole run, including any time since the last stage ended
+    peaks = [run['peak_rss_mb'], stage_peak_rss_mb()]
+    return max((peak for peak in peaks if peak is not None), default=None)
+
+
+def add_measure(totals, field, value):
+    if value is not None:
+        totals[field] = value if totals.get(field) is None else totals[field] + value
+
+
+@contextmanager
+def stage(run, name, rows_in=None):
+    record = {'rows_in': rows_in, 'rows_out': None}
+    if run is None:
+        yield record
+        return
+    if run['stage_memory']:
+        # Resetting the high-water mark would lose the run's and the enclosing stages' peak so far, so hand it to them first
+        peak = stage_peak_rss_mb()
+        run['peak_rss_mb'] = max(run['peak_rss_mb'] or 0, peak or 0) or None
+        for outer in run['active']:
+            outer['peak_rss_mb'] = max(outer['peak_rss_mb'] or 0, peak or 0)
+        reset_peak_rss()
+    record['peak_rss_mb'] = None
+    run['active'].append(record)
+    # Only one profiler can run at a time, a nested stage shows up inside its enclosing stage's profile
+    profile = None
+    if run['profile_dir'] and not run['profiling']:
+        profile = run['profiles'].setdefault(name, cProfile.Profile())
+        run['profiling'] = True
+        profile.enable()
+    read_start, written_start = io_counters()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        read_end, written_end = io_counters()
+        if profile is not None:
+            profile.disable()
+            run['profiling'] = False
+        run['active'].pop()
+        peak = max(record['peak_rss_mb'] or 0, stage_peak_rss_mb() or 0) or None
+        for outer in run['active']:
+            outer['peak_rss_mb'] = max(outer['peak_rss_mb'] or 0, peak or 0)
+        run['peak_rss_mb'] = max(run['peak_rss_mb'] or 0, peak or 0) or None
+
+        totals = run['stages'].setdefault(name, dict.fromkeys(STAGE_FIELDS))
+        add_measure(totals, 'calls', 1)
+        add_measure(totals, 'wall_s', wall)
+        add_measure(totals, 'cpu_s', cpu)
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'] or 0, peak or 0) or None
+        add_measure(totals, 'rows_in', record['rows_in'])
+        add_measure(totals, 'rows_out', record['rows_out'])
+        if read_start is not None and read_end is not None:
+            add_measure(totals, 'bytes_read', read_end - read_start)
+            add_measure(totals, 'bytes_written', written_end - written_start)
+
+
+def stage_records(run):
+    return [{'run_id': run['run_id'], 'run': run['name'], 'stage': name, **totals} for name, totals in run['stages'].items()]
+
+
+def write_run_log(run, path=RUN_LOG_PATH):
+    # Append this run's stages to the JSON lines log and dump any profiles next to it
+    records = stage_records(run)
+    if path:
+        with open(path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    if run['profile_dir']:
+        os.makedirs(run['profile_dir'], exist_ok=True)
+        for name, profile in run['profiles'].items():
+            profile.dump_stats(os.path.join(run['profile_dir'], f"{run['run_id']}.{name}.prof"))
+    return records
+
+
+def print_stages(run):
+    print(f"{'stage':<22}{'calls':>6}{'wall s':>9}{'cpu s':>9}{'peak MB':>9}{'rows in':>11}{'rows out':>11}{'MB read':>9}{'MB written':>11}")
+    for name, totals in run['stages'].items():
+        def field(key, scale=1, digits=0):
+            value = totals[key]
+            return '' if value is None else f"{value / scale:.{digits}f}"
+        print(f"{name:<22}{field('calls'):>6}{field('wall_s', digits=3):>9}{field('cpu_s', digits=3):>9}"
+              f"{field('peak_rss_mb'):>9}{field('rows_in'):>11}{field('rows_out'):>11}"
+              f"{field('bytes_read', 2**20, 1):>9}{field('bytes_written', 2**20, 1):>11}")
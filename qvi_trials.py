@@ -0,0 +1,401 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pandas as pd
+
+from qvi_cache import CACHE_DIR, FACTS_PATH, cached_table, merged_sources, sales_cents
+
+
+# total sales revenue
+# total number of customers
+# average number of transactions per customer
+
+def calculate_metrics(data, store_ids):
+    data = data[data['store_number'].isin(store_ids)]
+    metrics = data.assign(total_sales=sales_cents(data['total_sales']) / 100).groupby('month').agg(
+        total_sales=('total_sales', 'sum'),
+        total_cust=('loyalty_card_number', 'nunique'),
+        total_trans=('loyalty_card_number', 'size')
+    )
+    metrics['avg_trans'] = metrics['total_trans'] / metrics['total_cust']
+    return metrics.drop(columns='total_trans').reset_index()
+
+
+def store_month_metrics(data, distinct='exact', relative_error=None, sketches=None):
+    # Every store's monthly metrics in a single grouped pass; avg_trans is rows over distinct customers
+    # Sales are summed from exact cents, the compact schema stores them as float32
+    # distinct='hll' estimates the distinct customers from HyperLogLog sketches instead of exact hash sets,
+    # sketches takes the (keys, registers) of store_month_sketches when the caller built them already
+    sales = data.assign(total_sales=sales_cents(data['total_sales']) / 100).groupby(['store_number', 'month'])
+    if distinct == 'hll':
+        from qvi_hll import DEFAULT_ERROR, estimate, precision_for_error, store_month_sketches
+        metrics = sales.agg(total_sales=('total_sales', 'sum'), total_trans=('loyalty_card_number', 'size'))
+        if sketches is None:
+            sketches = store_month_sketches(data, precision_for_error(relative_error or DEFAULT_ERROR))
+        keys, registers = sketches
+        customers = pd.Series(estimate(registers), index=pd.MultiIndex.from_frame(keys))
+        metrics['total_cust'] = customers.reindex(metrics.index).to_numpy()
+        metrics = metrics[['total_sales', 'total_cust', 'total_trans']]
+    else:
+        metrics = sales.agg(
+            total_sales=('total_sales', 'sum'),
+            total_cust=('loyalty_card_number', 'nunique'),
+            total_trans=('loyalty_card_number', 'size')
+        )
+    metrics['avg_trans'] = metrics['total_trans'] / metrics['total_cust']
+    return metrics.drop(columns='total_trans').reset_index()
+
+
+# Memoized per (store, month) metrics.
+# The metrics of every store and month are computed in one grouped pass, kept sorted by store with
+# each store's row range, so one store's monthly metrics are a single slice instead of a fresh scan.
+# Tables are held in memory per version of the merged data, the least recently used dropped beyond
+# METRIC_CACHE_ENTRIES, and are also kept under .qvi_cache so a new session starts warm. With
+# distinct='hll' the store keeps the (store, month) HyperLogLog sketches next to the table, so
+# customers can be rolled up to stores, regions or the chain without the rows; those are held in
+# memory only.
+
+METRIC_CACHE_ENTRIES = 8
+METRIC_COLUMNS = ['month', 'total_sales', 'total_cust', 'avg_trans']
+STORE_MONTH_COLUMNS = ['date', 'store_number', 'loyalty_card_number', 'total_sales']
+STORE_METRICS_SCHEMA = 1
+
+_metric_stores = OrderedDict()
+
+
+def index_metrics(metrics):
+    metrics = metrics.sort_values(['store_number', 'month'], kind='stable').reset_index(drop=True)
+    stores, starts = np.unique(metrics['store_number'].to_numpy(), return_index=True)
+    stops = np.append(starts[1:], len(metrics))
+    return {
+        'metrics': metrics,
+        'slices': {store: slice(start, stop) for store, start, stop in zip(stores.tolist(), starts.tolist(), stops.tolist())}
+    }
+
+
+def store_month_sheet(path=FACTS_PATH, cache_dir=CACHE_DIR):
+    from qvi_cache import load_merged
+    sheet = load_merged(columns=STORE_MONTH_COLUMNS, path=path, cache_dir=cache_dir)
+    return sheet.assign(month=sheet['date'].dt.strftime('%Y%m'))
+
+
+def store_metrics(path=FACTS_PATH, cache_dir=CACHE_DIR, persist=True, distinct='exact', relative_error=None):
+    sources = merged_sources(path)
+    key = json.dumps([sources, distinct, relative_error], sort_keys=True)
+    if key in _metric_stores:
+        _metric_stores.move_to_end(key)
+        return _metric_stores[key]
+    sketches = None
+    if persist and distinct == 'exact':
+        metrics = cached_table(os.path.join(cache_dir, "store_metrics"), sources,
+                               lambda: store_month_metrics(store_month_sheet(path, cache_dir)).astype({'month': 'category'}),
+                               STORE_METRICS_SCHEMA, mmap=False)
+    else:
+        sheet = store_month_sheet(path, cache_dir)
+        if distinct == 'hll':
+            from qvi_hll import DEFAULT_ERROR, precision_for_error, store_month_sketches
+            sketches = store_month_sketches(sheet, precision_for_error(relative_error or DEFAULT_ERROR))
+        metrics = store_month_metrics(sheet, distinct, relative_error, sketches)
+    _metric_stores[key] = index_metrics(metrics.astype({'month': str}))
+    if sketches is not None:
+        _metric_stores[key]['sketches'] = {'keys': sketches[0], 'registers': sketches[1]}
+    while len(_metric_stores) > METRIC_CACHE_ENTRIES:
+        _metric_stores.popitem(last=False)
+    return _metric_stores[key]
+
+
+def lookup_metrics(metric_store, store):
+    # calculate_metrics(data, [store]) read from the memoized table
+    rows = metric_store['slices'].get(store, slice(0, 0))
+    return metric_store['metrics'].iloc[rows][METRIC_COLUMNS].reset_index(drop=True)
+
+
+def metric_matrix(metrics, metric):
+    # store x month matrix of one metric, months a store did not trade are NaN
+    matrix = metrics.pivot(index='store_number', columns='month', values=metric)
+    return pd.DataFrame(matrix.to_numpy(dtype=float, na_value=np.nan), index=matrix.index, columns=matrix.columns)
+
+
+def pearson_matrix(trial_values, control_values):
+    # Pearson correlation of every trial row against every control row, shape (trials, controls)
+    trial_centered = trial_values - trial_values.mean(axis=1, keepdims=True)
+    control_centered = control_values - control_values.mean(axis=1, keepdims=True)
+    trial_norm = np.linalg.norm(trial_centered, axis=1, keepdims=True)
+    control_norm = np.linalg.norm(control_centered, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (trial_centered @ control_centered.T) / (trial_norm @ control_norm.T)
+
+
+def rank_control_stores(matrix, trial_stores, potential_control, top_k=1):
+    trial_values = matrix.reindex(trial_stores).to_numpy()
+    control_values = matrix.reindex(potential_control).to_numpy()
+    control_index = np.asarray(potential_control)
+    trial_observed = ~np.isnan(trial_values)
+    control_observed = ~np.isnan(control_values)
+    rankings = {}
+    # Trial stores trading in the same months are scored together in one matrix product,
+    # against the candidates that traded in exactly those months
+    for mask in np.unique(trial_observed, axis=0):
+        rows = np.flatnonzero((trial_observed == mask).all(axis=1))
+        eligible = np.flatnonzero((control_observed == mask).all(axis=1))
+        if mask.sum() < 2:
+            eligible = eligible[:0]
+        scores = pearson_matrix(trial_values[np.ix_(rows, mask)], control_values[np.ix_(eligible, mask)])
+        for row, row_scores in zip(rows, scores):
+            # Same rule as the original loop: ties keep candidate order, NaN and -1 never win
+            keep = np.flatnonzero(row_scores > -1)
+            order = keep[np.argsort(-row_scores[keep], kind='stable')][:top_k]
+            rankings[trial_stores[row]] = pd.DataFrame({
+                'control_store': control_index[eligible[order]],
+                'correlation': row_scores[order]
+            })
+    return rankings
+
+
+def find_control_store(data, trial_store, potential_control, metric):
+    matrix = metric_matrix(store_month_metrics(data), metric)
+    ranking = rank_control_stores(matrix, [trial_store], potential_control)[trial_store]
+    if ranking.empty:
+        return None
+    return ranking['control_store'].iloc[0]
+
+
+# Pre-trial control selection.
+# Controls are scored only on the months before the trial started, so the trial's own effect can't
+# make a store look more or less similar. Stores are aligned on month and compared over the months
+# both of them traded, instead of candidates with a gap being dropped. The score blends Pearson
+# correlation with a magnitude score, 1 for the closest candidate in a month and 0 for the furthest.
+# The per-store window sums are computed once per metric and shared by every trial store scored
+# against them, so each extra trial store is a few matrix-vector products over the stores; on a
+# memoized metric store they are kept per (metric, trial start, window) by metric_pretrial_stats.
+# A control is brought to its trial store's level by the ratio of their pre-trial totals over the
+# months both traded, the same rule for the selection metric's scaling_factor and for every other metric.
+
+TRIAL_START = '201902'
+MIN_PRETRIAL_MONTHS = 3
+MAGNITUDE_WEIGHT = 0.5
+# Name of the scaling rule described above, changed with the rule so trial stages cached under the old one aren't reused
+SCALING_RULE = 'pretrial_total_ratio'
+
+
+def pretrial_stats(matrix, trial_start=TRIAL_START, window=None):
+    # window is the number of months before trial_start to use, None for all of them
+    months = [month for month in matrix.columns if month < trial_start]
+    if window is not None:
+        months = months[-window:]
+    values = matrix[months].to_numpy(dtype=float)
+    observed = ~np.isnan(values)
+    values = np.where(observed, values, 0.0)
+    return {
+        'stores': matrix.index.to_numpy(),
+        'row_of': {store: row for row, store in enumerate(matrix.index)},
+        'months': months,
+        'values': values,
+        'squares': values * values,
+        'observed': observed.astype(float)
+    }
+
+
+def score_control_stores(stats, trial_store, potential_control, magnitude_weight=MAGNITUDE_WEIGHT,
+                         min_months=MIN_PRETRIAL_MONTHS):
+    rows = np.array([stats['row_of'][store] for store in potential_control if store in stats['row_of']], dtype=int)
+    if trial_store in stats['row_of']:
+        trial, trial_observed = stats['values'][stats['row_of'][trial_store]], stats['observed'][stats['row_of'][trial_store]]
+    else:
+        # A trial store with no metrics shares no months with any candidate, so the ranking comes back empty
+        # and the trial store gets no control, as rank_control_stores leaves it
+        trial = trial_observed = np.zeros(len(stats['months']))
+    values, squares, observed = stats['values'][rows], stats['squares'][rows], stats['observed'][rows]
+    # Sums over the months each candidate shares with the trial store
+    months = observed @ trial_observed
+    trial_sum = observed @ trial
+    trial_squares = observed @ (trial * trial)
+    control_sum = values @ trial_observed
+    control_squares = squares @ trial_observed
+    cross = values @ trial
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = cross - trial_sum * control_sum / months
+        trial_var = trial_squares - trial_sum ** 2 / months
+        control_var = control_squares - control_sum ** 2 / months
+        correlation = covariance / np.sqrt(trial_var * control_var)
+
+        common = (observed * trial_observed) > 0
+        distance = np.abs(values - trial)
+        low = np.where(common, distance, np.inf).min(axis=0)
+        high = np.where(common, distance, -np.inf).max(axis=0)
+        # A month where every candidate is equally far away counts as a match for all of them
+        closeness = np.where(high > low, 1 - (distance - low) / (high - low), 1.0)
+        magnitude = np.where(common, closeness, 0.0).sum(axis=1) / months
+        scaling_factor = np.where(control_sum != 0, trial_sum / control_sum, np.nan)
+    score = magnitude_weight * magnitude + (1 - magnitude_weight) * correlation
+    ranking = pd.DataFrame({
+        'control_store': stats['stores'][rows],
+        'correlation': correlation,
+        'magnitude': magnitude,
+        'score': score,
+        'months': months.astype(int),
+        'scaling_factor': scaling_factor
+    })
+    ranking = ranking[(ranking['months'] >= min_months) & ranking['score'].notna()]
+    return ranking.sort_values('score', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def metric_pretrial_stats(metric_store, metric, trial_start=TRIAL_START, window=None):
+    # pretrial_stats of one metric, kept on the memoized metric store so every caller scoring the same window shares them
+    cached = metric_store.setdefault('pretrial_stats', {})
+    key = (metric, trial_start, window)
+    if key not in cached:
+        cached[key] = pretrial_stats(metric_matrix(metric_store['metrics'], metric), trial_start, window)
+    return cached[key]
+
+
+def select_pretrial_controls(metrics, trial_stores, potential_control, metric='total_sales', trial_start=TRIAL_START,
+                             window=None, magnitude_weight=MAGNITUDE_WEIGHT, top_k=1, stats=None):
+    if stats is None:
+        stats = pretrial_stats(metric_matrix(metrics, metric), trial_start, window)
+    return {
+        trial_store: score_control_stores(stats, trial_store, potential_control, magnitude_weight).head(top_k)
+        for trial_store in trial_stores
+    }
+
+
+def pretrial_scaling_factor(stats, trial_store, control_store):
+    # Trial over control pre-trial totals on the months both traded, NaN when the control has nothing to scale
+    trial_row, control_row = stats['row_of'][trial_store], stats['row_of'][control_store]
+    shared = stats['observed'][trial_row] * stats['observed'][control_row]
+    control_sum = stats['values'][control_row] @ shared
+    return stats['values'][trial_row] @ shared / control_sum if control_sum else np.nan
+
+
+def pretrial_scaling_factors(metric_store, trial_store, control_store, metrics=METRIC_COLUMNS[1:], trial_start=TRIAL_START, window=None):
+    return {
+        metric: pretrial_scaling_factor(metric_pretrial_stats(metric_store, metric, trial_start, window), trial_store, control_store)
+        for metric in metrics
+    }
+
+
+def scale_control_metrics(control, scaling_factors):
+    # A control store's monthly metrics brought to the trial store's pre-trial level, scaling_factors maps metric -> factor
+    return control.assign(**{metric: control[metric] * factor for metric, factor in scaling_factors.items()})
+
+
+def perform_t_test(df, metric_trial, metric_control):
+    from scipy.stats import ttest_rel
+    df = df.sort_values(by='month')
+    t_stat, p_value = ttest_rel(df[metric_trial], df[metric_control])
+    return t_stat, p_value
+
+
+# Multi-trial runner.
+# The store x month metric table is built once and placed in shared memory, worker processes
+# attach to it read-only and each evaluates one trial store: control selection on every
+# selection metric, then paired t-tests of trial against control on every store metric.
+# Trial stores are handed out and collected in order, so results don't depend on worker count.
+
+STORE_METRICS = ['total_sales', 'total_cust', 'avg_trans']
+
+_shared = {}
+
+
+def metric_table(metrics):
+    matrices = [metric_matrix(metrics, metric) for metric in STORE_METRICS]
+    stores = matrices[0].index.to_numpy()
+    months = matrices[0].columns.to_numpy()
+    values = np.stack([matrix.reindex(index=stores, columns=months).to_numpy() for matrix in matrices])
+    return stores, months, values
+
+
+def _use_table(values, stores, months, potential_control):
+    _shared.update(values=values, stores=stores, months=months, potential_control=potential_control)
+
+
+def _attach_table(name, shape, stores, months, potential_control):
+    # Workers share the parent's resource tracker, so the block is still unlinked once by the parent
+    shm = SharedMemory(name=name)
+    values = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    values.flags.writeable = False
+    _shared['shm'] = shm
+    _use_table(values, stores, months, potential_control)
+
+
+def evaluate_trial(trial_store, selection_metrics):
+    from scipy.stats import ttest_rel
+    values, stores, months = _shared['values'], _shared['stores'], _shared['months']
+    row_of = {store: row for row, store in enumerate(stores)}
+    results = []
+    for selection_metric in selection_metrics:
+        matrix = pd.DataFrame(values[STORE_METRICS.index(selection_metric)], index=stores, columns=months)
+        ranking = rank_control_stores(matrix, [trial_store], _shared['potential_control'])[trial_store]
+        if ranking.empty:
+            continue
+        control_store, correlation = ranking['control_store'].iloc[0], ranking['correlation'].iloc[0]
+        for metric in STORE_METRICS:
+            trial = values[STORE_METRICS.index(metric), row_of[trial_store]]
+            control = values[STORE_METRICS.index(metric), row_of[control_store]]
+            # Only the months both stores traded, as the month join in store_trial.trial_t_tests pairs them
+            traded = ~np.isnan(trial) & ~np.isnan(control)
+            t_stat, p_value = ttest_rel(trial[traded], control[traded])
+            results.append({
+                'trial_store': trial_store,
+                'selection_metric': selection_metric,
+                'control_store': control_store,
+                'correlation': correlation,
+                'metric': metric,
+                't_stat': t_stat,
+                'p_value': p_value
+            })
+    return results
+
+
+def run_trials(metrics, trial_stores, selection_metrics=('total_sales',), workers=None):
+    stores, months, values = metric_table(metrics)
+    potential_control = [store for store in stores if store not in trial_stores]
+    selection_metrics = list(selection_metrics)
+    if workers == 1:
+        _use_table(values, stores, months, potential_control)
+        results = [evaluate_trial(trial_store, selection_metrics) for trial_store in trial_stores]
+    else:
+        shm = SharedMemory(create=True, size=values.nbytes)
+        try:
+            np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf)[:] = values
+            initargs = (shm.name, values.shape, stores, months, potential_control)
+            with ProcessPoolExecutor(workers, initializer=_attach_table, initargs=initargs) as pool:
+                results = list(pool.map(evaluate_trial, trial_stores, repeat(selection_metrics)))
+        finally:
+            shm.close()
+            shm.unlink()
+    return pd.DataFrame([row for rows in results for row in rows])
+
+
+def speedup_curve(metrics, trial_stores, selection_metrics=('total_sales',), worker_counts=None):
+    # Time the runner at each worker count against the single process run, checking the results match;
+    # the single process run is always timed first, whatever worker_counts holds
+    worker_counts = worker_counts or range(1, (os.cpu_count() or 1) + 1)
+    worker_counts = [1] + [workers for workers in worker_counts if workers != 1]
+    curve = []
+    serial = None
+    for workers in worker_counts:
+        start = time.perf_counter()
+        results = run_trials(metrics, trial_stores, selection_metrics, workers)
+        seconds = time.perf_counter() - start
+        if serial is None:
+            serial = (results, seconds)
+        curve.append({
+            'workers': workers,
+            'seconds': seconds,
+            'speedup': serial[1] / seconds,
+            'matches_first': results.equals(serial[0])
+        })
+    return pd.DataFrame(curve)
+
+
+if __name__ == '__main__':
+    # Speedup of evaluating every store as a trial store, selecting controls on every metric
+    metrics = store_metrics()['metrics']
+    print(speedup_curve(metrics, list(metrics['store_number'].unique()), STORE_METRICS))
@@ -1,134 +1,152 @@
+import argparse
+
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from matplotlib.ticker import MultipleLocator, FormatStrFormatter, AutoMinorLocator
-from scipy.stats import pearsonr, ttest_rel
-import scipy.stats as stats
-import numpy as np
-
-
-# total sales revenue
-# total number of customers
-# average number of transactions per customer
-
-def calculate_metrics(data, store_ids):
-    return data[data['store_number'].isin(store_ids)].groupby('month').agg(
-        total_sales=('total_sales', 'sum'),
-        total_cust=('loyalty_card_number', 'nunique'),
-        avg_trans=('loyalty_card_number', lambda x: len(x) / x.nunique())
-    ).reset_index()
-
-def find_control_store(data, trial_store, potential_control, metric):
-    trial_metrics = calculate_metrics(data, [trial_store])
-    best_correlation = -1
-    best_control_store = None
-    for control in potential_control:
-        control_metrics = calculate_metrics(data, [control])
-        # Number of monthly data should match
-        if len(trial_metrics) == len(control_metrics):
-            correlation, pvalue = pearsonr(trial_metrics[metric], control_metrics[metric])
-            if correlation > best_correlation: 
-                best_correlation = correlation
-                best_control_store = control
-    return best_control_store
-
-def perform_t_test(df, metric_trial, metric_control):
-    df = df.sort_values(by='month')
-    t_stat, p_value = ttest_rel(df[metric_trial], df[metric_control])
-    return t_stat, p_value
-
-# Load dataset
-sheet = pd.read_csv("merged_df.csv").convert_dtypes()
-# Add a month column
-sheet['date'] = pd.to_datetime(sheet['date'])
-sheet['month'] = sheet['date'].dt.strftime('%Y%m')
-# Generate list of potential control stores + trial stores
-trial_stores = [77,86,88]
-potential_control_stores = sheet['store_number'].unique()
-# include all stores except trial stores
-potential_control_stores = [store for store in potential_control_stores if store not in trial_stores]
-# Find control stores for each trial store
-control_stores = {trial_store: find_control_store(sheet, trial_store, potential_control_stores, 'total_sales') for trial_store in trial_stores}
-# Output of control_stores: {77: 35, 86: 231, 88: 159}
-
-# Calculate metrics for trial and control stores
-trial_metrics = {store: calculate_metrics(sheet, [store]) for store in trial_stores}
-control_metrics = {store: calculate_metrics(sheet, [control_stores[store]]) for store in trial_stores}
-
-# Compare trial and control stores by joining metrics on months
-comparison_results_list = []
-for store in trial_stores:
-    trial_data = trial_metrics[store].set_index('month')
-    control_data = control_metrics[store].set_index('month')
-    comparison = trial_data.join(control_data, lsuffix='_trial', rsuffix='_control')
-    comparison['store_number'] = store
-    comparison_results_list.append(comparison.reset_index())
-comparison_results = pd.concat(comparison_results_list, ignore_index=True)
-print(comparison_results)
-
-ttest_results = {}
-for store in trial_stores:
-    store_data = comparison_results[comparison_results['store_number'] == store]
-    ttest_results[store] = {
-        'sales_diff': perform_t_test(store_data, 'total_sales_trial', 'total_sales_control'),
-        'customers_diff': perform_t_test(store_data, 'total_cust_trial', 'total_cust_control'),
-        'transactions_diff': perform_t_test(store_data, 'avg_trans_trial', 'avg_trans_control')
+from qvi_render import render_charts
+from qvi_resample import trial_uplifts
+from qvi_plots import line_chart
+from qvi_trials import (TRIAL_START, store_metrics, lookup_metrics, metric_matrix, metric_pretrial_stats, rank_control_stores, perform_t_test,
+                        pretrial_scaling_factors, scale_control_metrics, select_pretrial_controls)
+
+
+# Every store's monthly metrics come from the memoized metric store in qvi_trials, computed once per
+# version of the data and sliced per store from then on.
+# Controls are picked either on every month (selection='all', the original analysis) or on the months
+# before the trial only (selection='pretrial'), where each control is also scaled to its trial store's
+# pre-trial level before the comparison, t-tests and uplift.
+
+def select_control_stores(metric_store, trial_stores, metric='total_sales'):
+    # include all stores except trial stores
+    potential_control_stores = [store for store in metric_store['slices'] if store not in trial_stores]
+    # Find control stores for each trial store, scoring every trial against every candidate at once
+    control_rankings = rank_control_stores(metric_matrix(metric_store['metrics'], metric), trial_stores, potential_control_stores)
+    # A trial store without any eligible candidate gets None, as find_control_store returns
+    return {
+        trial_store: None if control_rankings[trial_store].empty else control_rankings[trial_store]['control_store'].iloc[0]
+        for trial_store in trial_stores
     }
-for store, results in ttest_results.items():
-    print(f"Trial Store {store}")
-    print(f"  Sales Difference: t-statistic = {results['sales_diff'][0]:.2f}, p-value = {results['sales_diff'][1]:.10f}")
-    print(f"  Customers Difference: t-statistic = {results['customers_diff'][0]:.2f}, p-value = {results['customers_diff'][1]:.10f}")
-    print(f"  Transactions Difference: t-statistic = {results['transactions_diff'][0]:.2f}, p-value = {results['transactions_diff'][1]:.10f}")
-# We can see that transaction frequency isn't significantly different for store 77 with a p value of 0.3256
-# Everything else is significantly different, store 86 experiences a negative decline in sales and customer frequency
-
-# Calculate differences in metrics
-comparison_results['sales_diff'] = comparison_results['total_sales_trial'] - comparison_results['total_sales_control']
-comparison_results['customers_diff'] = comparison_results['total_cust_trial'] - comparison_results['total_cust_control']
-comparison_results['transactions_diff'] = comparison_results['avg_trans_trial'] - comparison_results['avg_trans_control']
-
-# print(f"Sales Diff: {stats.ttest_ind(comparison_results['total_sales_trial'], comparison_results['total_sales_control'], equal_var = False)}")
-# print(f"Customer Diff: {stats.ttest_ind(comparison_results['total_cust_trial'], comparison_results['total_cust_control'], equal_var = False)}")
-# print(f"Transaction Diff: {stats.ttest_ind(comparison_results['avg_trans_trial'], comparison_results['avg_trans_control'], equal_var = False)}")
-
-
-# Plot results
-plt.figure(figsize=(12, 8))
-sns.lineplot(data=comparison_results, x='month', y='sales_diff', hue='store_number', marker='o')
-plt.title('Difference in Total Sales Between Trial and Control Stores')
-plt.xlabel('Month')
-plt.ylabel('Sales Difference')
-plt.legend(title='Trial Store Number')
-plt.show()
-
-plt.figure(figsize=(12, 8))
-sns.lineplot(data=comparison_results, x='month', y='customers_diff', hue='store_number', marker='o')
-plt.title('Difference in Total Customers Between Trial and Control Stores')
-plt.xlabel('Month')
-plt.ylabel('Customers Difference')
-plt.legend(title='Trial Store Number')
-plt.show()
-
-plt.figure(figsize=(12, 8))
-sns.lineplot(data=comparison_results, x='month', y='transactions_diff', hue='store_number', marker='o')
-plt.title('Difference in Average Transactions per Customer Between Trial and Control Stores')
-plt.xlabel('Month')
-plt.ylabel('Transactions Difference')
-plt.legend(title='Trial Store Number')
-plt.show()
-
-# Save the results to a PDF
-import matplotlib.backends.backend_pdf
-pdf = matplotlib.backends.backend_pdf.PdfPages("store_trial_analysis.pdf")
-figs = [plt.figure(n) for n in plt.get_fignums()]
-for fig in figs:
-    fig.savefig(pdf, format='pdf')
-pdf.close()
+
+
+def select_pretrial_control_stores(metric_store, trial_stores, metric='total_sales', trial_start=TRIAL_START, window=None):
+    # Controls scored on the months before the trial only, with the factor that scales each one to its trial store
+    potential_control_stores = [store for store in metric_store['slices'] if store not in trial_stores]
+    rankings = select_pretrial_controls(metric_store['metrics'], trial_stores, potential_control_stores, metric, trial_start, window,
+                                        stats=metric_pretrial_stats(metric_store, metric, trial_start, window))
+    return pd.concat(rankings, names=['trial_store']).reset_index(level=0).reset_index(drop=True)
+
+
+def select_trial_controls(metric_store, trial_stores, selection='all', metric='total_sales', trial_start=TRIAL_START, window=None):
+    # Control store per trial store, and per trial store the factors scaling its control's metrics (None for selection='all')
+    if selection == 'all':
+        return select_control_stores(metric_store, trial_stores, metric), None
+    if selection != 'pretrial':
+        raise ValueError(f"Unknown control selection {selection}")
+    ranking = select_pretrial_control_stores(metric_store, trial_stores, metric, trial_start, window).set_index('trial_store')
+    control_stores = {store: ranking['control_store'].get(store) for store in trial_stores}
+    scaling_factors = {
+        store: pretrial_scaling_factors(metric_store, store, control, trial_start=trial_start, window=window)
+        for store, control in control_stores.items() if control is not None
+    }
+    return control_stores, scaling_factors
+
+
+def compare_trial_stores(metric_store, trial_stores, control_stores, scaling_factors=None):
+    # Metrics for trial and control stores, controls scaled to their trial store when scaling factors are given
+    trial_metrics = {store: lookup_metrics(metric_store, store) for store in trial_stores}
+    control_metrics = {store: lookup_metrics(metric_store, control_stores[store]) for store in trial_stores}
+    if scaling_factors:
+        control_metrics = {store: scale_control_metrics(control_metrics[store], scaling_factors[store]) if store in scaling_factors else control_metrics[store]
+                           for store in trial_stores}
+
+    # Compare trial and control stores by joining metrics on months
+    comparison_results_list = []
+    for store in trial_stores:
+        trial_data = trial_metrics[store].set_index('month')
+        control_data = control_metrics[store].set_index('month')
+        comparison = trial_data.join(control_data, lsuffix='_trial', rsuffix='_control')
+        comparison['store_number'] = store
+        comparison_results_list.append(comparison.reset_index())
+    comparison_results = pd.concat(comparison_results_list, ignore_index=True)
+
+    # Calculate differences in metrics
+    comparison_results['sales_diff'] = comparison_results['total_sales_trial'] - comparison_results['total_sales_control']
+    comparison_results['customers_diff'] = comparison_results['total_cust_trial'] - comparison_results['total_cust_control']
+    comparison_results['transactions_diff'] = comparison_results['avg_trans_trial'] - comparison_results['avg_trans_control']
+    return comparison_results
+
+
+def trial_t_tests(comparison_results, trial_stores):
+    ttest_results = {}
+    for store in trial_stores:
+        store_data = comparison_results[comparison_results['store_number'] == store]
+        ttest_results[store] = {
+            'sales_diff': perform_t_test(store_data, 'total_sales_trial', 'total_sales_control'),
+            'customers_diff': perform_t_test(store_data, 'total_cust_trial', 'total_cust_control'),
+            'transactions_diff': perform_t_test(store_data, 'avg_trans_trial', 'avg_trans_control')
+        }
+    return ttest_results
+
+
+def trial_charts(comparison_results):
+    return [
+        ('sales_diff', line_chart, dict(data=comparison_results, x='month', y='sales_diff', hue='store_number', title='Difference in Total Sales Between Trial and Control Stores', xlabel='Month', ylabel='Sales Difference', legend_title='Trial Store Number', tight=False)),
+        ('customers_diff', line_chart, dict(data=comparison_results, x='month', y='customers_diff', hue='store_number', title='Difference in Total Customers Between Trial and Control Stores', xlabel='Month', ylabel='Customers Difference', legend_title='Trial Store Number', tight=False)),
+        ('transactions_diff', line_chart, dict(data=comparison_results, x='month', y='transactions_diff', hue='store_number', title='Difference in Average Transactions per Customer Between Trial and Control Stores', xlabel='Month', ylabel='Transactions Difference', legend_title='Trial Store Number', tight=False))
+    ]
+
+
+def print_t_tests(ttest_results):
+    for store, results in ttest_results.items():
+        print(f"Trial Store {store}")
+        print(f"  Sales Difference: t-statistic = {results['sales_diff'][0]:.2f}, p-value = {results['sales_diff'][1]:.10f}")
+        print(f"  Customers Difference: t-statistic = {results['customers_diff'][0]:.2f}, p-value = {results['customers_diff'][1]:.10f}")
+        print(f"  Transactions Difference: t-statistic = {results['transactions_diff'][0]:.2f}, p-value = {results['transactions_diff'][1]:.10f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the trial stores against their control stores")
+    parser.add_argument('--selection', choices=['all', 'pretrial'], default='all',
+                        help="pick controls on every month, or on the pre-trial months with controls scaled to the trial store")
+    parser.add_argument('--trial-start', default=TRIAL_START, help="first trial month, YYYYMM")
+    parser.add_argument('--window', type=int, help="pre-trial months to select and scale on, default all of them")
+    args = parser.parse_args(argv)
+    if args.window is not None and args.window < 1:
+        parser.error(f"argument --window: the pre-trial window needs at least 1 month, got {args.window}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    metric_store = store_metrics()
+    trial_stores = [77,86,88]
+    control_stores, scaling_factors = select_trial_controls(metric_store, trial_stores, args.selection, trial_start=args.trial_start, window=args.window)
+    # Output of control_stores: {77: 35, 86: 231, 88: 159}
+    print(control_stores)
+    # Trial stores without a control, in either selection, are left out of the comparison
+    for store in [store for store, control in control_stores.items() if control is None]:
+        print(f"No control store found for trial store {store}")
+    trial_stores = [store for store in trial_stores if control_stores[store] is not None]
+    if scaling_factors is not None:
+        print(pd.DataFrame(scaling_factors).T.rename_axis('trial_store'))
+    comparison_results = compare_trial_stores(metric_store, trial_stores, control_stores, scaling_factors)
+    print(comparison_results.drop(columns=['sales_diff', 'customers_diff', 'transactions_diff']))
+
+    print_t_tests(trial_t_tests(comparison_results, trial_stores))
+    # We can see that transaction frequency isn't significantly different for store 77 with a p value of 0.3256
+    # Everything else is significantly different, store 86 experiences a negative decline in sales and customer frequency
+
+    # With only a handful of months per store, check the t-tests against bootstrap intervals and sign-flip permutation p-values
+    print(trial_uplifts(comparison_results, trial_stores, ['total_sales', 'total_cust', 'avg_trans']))
+
+    # Plot results, every chart also goes into the PDF report
+    render_charts(trial_charts(comparison_results), pdf_path="store_trial_analysis.pdf")
+
+
+if __name__ == '__main__':
+    main()
 
 # # Analysis:
 # Total sales is significantly different for stores 77 and 88, Total customer is significantly different for stores 77 and 88.
 # Average Transactions is significantly different for store 86 and 88.
 
-# The results for trial stores 77 and 88 show a significant difference in at least two of the three trials months. 88 for all three trials and 76 for two trials The trial overall 
+# The results for trial stores 77 and 88 show a significant difference in at least two of the three trials months. 88 for all three trials and 76 for two trials The trial overall
 # showed a significant increase in sales, however not reflected in trial store 86, which we must reconvene with the client on that regard
-